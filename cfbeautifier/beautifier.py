@@ -1,7 +1,6 @@
 from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
-from . import parser
 from . import structure
 import copy
 
@@ -11,6 +10,10 @@ class Options(object):
         self.sorts_promise_types_to_evaluation_order = True
         self.page_width = 100
         self.line_endings = None
+        # "lines" or "document" (see document.py)
+        self.layout_engine = "lines"
+        # "ply" or "scanner" (see lexer.py)
+        self.lexer = "ply"
 
 def line_endings(string, line_endings):
     if line_endings:
@@ -19,9 +22,45 @@ def line_endings(string, line_endings):
         return "\r\n"
     return "\n"
 
-def beautified_string(string, options = None):
-    "Raises ParserError if fails to parse"
+def options_from_dict(values):
+    "Return Options with the values in dict values (for options that are passed as JSON)"
+    options = Options()
+    for name, value in values.items():
+        if hasattr(options, name):
+            setattr(options, name, value)
+    return options
+
+def layout_options(string, options = None):
+    "Return structure.Options for beautifying string with (beautifier.Options) options"
     options = copy.copy(options) or Options()
     options.line_endings = line_endings(string, options.line_endings)
-    options = structure.Options(options)
-    return parser.specification_from_string(string, options).to_string(options)
+    return structure.Options(options)
+
+def specification(string, options = None):
+    """
+    Return (structure.Specification, structure.Options) for beautifying string.
+    Raises ParserError if fails to parse.
+    """
+    # Imported only when needed, since building the parser is slow, and a daemon client does not
+    # need it
+    from . import parser
+    options = layout_options(string, options)
+    return (parser.specification_from_string(string, options), options)
+
+def beautified_string(string, options = None):
+    "Raises ParserError if fails to parse"
+    specification_node, options = specification(string, options)
+    return specification_node.to_string(options)
+
+def iter_chunks(string, options = None):
+    """
+    Yield the beautified string in parts, one for each bundle, body or standalone comment.
+    Raises ParserError if fails to parse, before yielding anything.
+    """
+    specification_node, options = specification(string, options)
+    return specification_node.iter_chunks(options)
+
+def write_to(stream, string, options = None):
+    "Write the beautified string to stream. Raises ParserError if fails to parse."
+    specification_node, options = specification(string, options)
+    specification_node.write_to(stream, options)
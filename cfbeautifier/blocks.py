@@ -0,0 +1,286 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from . import beautifier
+from . import lexer
+from .util import ParserError
+from .version_abstraction import write_stream
+import copy
+import multiprocessing
+
+# Splits a document into regions that can be parsed and beautified independently. This is the rule
+# for splitting a document both when beautifying it in parts (here) and when reparsing the parts of
+# an edited document (session.py). A region ends with the line on which a top level bundle or body
+# closes, if a bundle or body follows on a later line, so the empty lines and the comments before
+# a bundle or body are in its region, as is the end-of-line comment after its closing brace. The
+# last region has the last bundle or body and everything after it. Bundles and bodies that share a
+# line are in the same region.
+#
+# A region starts and ends outside of any bundle, body and quoted string, and has the comments and
+# empty lines that are given to its bundles and bodies, so nothing outside a region affects how it
+# is parsed. The beautified document is the beautified regions separated by empty lines.
+
+def iter_regions(string, options = None, is_followed_by_block = False):
+    """
+    Yield the regions of string as (start, end) offsets, each once it has been lexed.
+    Raises ParserError if fails to lex. options and is_followed_by_block as in regions.
+    """
+    the_lexer = lexer.lexer_for(options or beautifier.Options())
+    the_lexer.input(string)
+    start = 0
+    depth = 0
+    # Line of the closing brace of the previous block, if the region may end there
+    end_line_number = None
+    for token in iter(the_lexer.token, None):
+        if end_line_number is not None:
+            if end_line_number < token.lineno:
+                end = string.find("\n", end_pos) + 1
+                yield (start, end)
+                start = end
+            end_line_number = None
+        if token.type == "OPEN_BRACE":
+            depth += 1
+        elif token.type == "CLOSE_BRACE":
+            depth -= 1
+            if depth == 0:
+                end_line_number = token.lineno
+                end_pos = token.lexpos
+    if end_line_number is not None and is_followed_by_block:
+        end = string.find("\n", end_pos) + 1
+        if end:
+            yield (start, end)
+            start = end
+    yield (start, len(string))
+
+def regions(string, options = None, is_followed_by_block = False):
+    """
+    Return the regions of string as (start, end) offsets. Raises ParserError if fails to lex.
+    options: selects the lexer, as in parsing
+    is_followed_by_block: True if string is a part of a document that a bundle or body follows on
+                          a later line. A bundle or body that closes on the last line of string
+                          then ends a region, and the last region, which may be empty, has the
+                          rest of string.
+    """
+    return list(iter_regions(string, options, is_followed_by_block))
+
+def _translated_error(error, string, start, start_line_number):
+    "Return ParserError error of the region at start in string, with the position in string"
+    if not error.line_number: # End of file
+        return error
+    return ParserError(error.fragment, error.line_number + start_line_number - 1, string,
+                       error.position + start)
+
+def region_specification(string, options, start, end, start_line_number):
+    """
+    Return the Specification of the region of string between offsets start and end, which starts
+    on line start_line_number. Raises ParserError if fails to parse, with the position in string.
+    """
+    # Imported only when needed, as in beautifier
+    from . import parser
+    try:
+        return parser.specification_from_string(string[start:end], options)
+    except ParserError as error:
+        raise _translated_error(error, string, start, start_line_number)
+
+def _region_string(string, options, start, end, start_line_number):
+    "Raises ParserError if fails to parse, with the position in string"
+    return region_specification(string, options, start, end, start_line_number).to_string(options)
+
+def parsed_regions(string, options):
+    """
+    Yield the regions of string as (start, end, Specification), each parsed once it has been
+    lexed. Raises ParserError if fails to parse, the same as parsing the whole string would.
+    """
+    start_line_number = 1
+    region_start = 0
+    all_regions = iter_regions(string, options)
+    while True:
+        try:
+            start, end = next(all_regions)
+        except StopIteration:
+            return
+        except ParserError as error:
+            # Parsing may fail before the position that lexing failed at
+            region_specification(string, options, region_start, len(string), start_line_number)
+            raise error
+        yield (start, end, region_specification(string, options, start, end, start_line_number))
+        start_line_number += string.count("\n", start, end)
+        region_start = end
+
+def _beautify_regions_in_worker(args):
+    """
+    Return the beautified strings of region strings, and the error of the first region that fails
+    to parse as (fragment, line_number, position), or None. ParserError is not returned as is,
+    since it cannot be unpickled.
+    """
+    region_strings, options = args
+    layout_options = beautifier.layout_options("", options)
+    outputs = []
+    for region_string in region_strings:
+        try:
+            outputs.append(_region_string(region_string, layout_options, 0, len(region_string), 1))
+        except ParserError as error:
+            return (outputs, (error.fragment, error.line_number, error.position))
+    return (outputs, None)
+
+def _batches(string, regions, count):
+    "Return lists of consecutive regions, about count of them with about the same length"
+    batch_length = max(len(string) // count, 1)
+    batches = [[]]
+    length = 0
+    for start, end in regions:
+        if batch_length <= length:
+            batches.append([])
+            length = 0
+        batches[-1].append((start, end))
+        length += end - start
+    return batches
+
+def _beautified_regions_in_pool(string, options, jobs):
+    try:
+        all_regions = regions(string, options)
+    except ParserError:
+        # Beautify the regions before the error, and raise the error that parsing finds first
+        for output in beautified_regions(string, options):
+            yield output
+        return
+    # Some batches per process, so that a slow batch does not delay the end
+    batches = _batches(string, all_regions, jobs * 4)
+    line_endings = beautifier.line_endings(string, options.line_endings)
+    pool_options = copy.copy(options)
+    pool_options.line_endings = line_endings
+    pool = multiprocessing.Pool(min(jobs, len(batches)))
+    try:
+        args = ((([string[start:end] for start, end in batch], pool_options)
+                 for batch in batches))
+        start_line_number = 1
+        for batch, (outputs, error) in zip(batches, pool.imap(_beautify_regions_in_worker, args)):
+            for (start, end), output in zip(batch, outputs):
+                if output:
+                    yield output
+                start_line_number += string.count("\n", start, end)
+            if error:
+                start, end = batch[len(outputs)]
+                raise _translated_error(ParserError(error[0], error[1], string[start:end], error[2]),
+                                        string, start, start_line_number)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def beautified_regions(string, options = None, jobs = 1):
+    """
+    Yield the beautified strings of the regions of string, which joined by line endings are the
+    same as beautifier.beautified_string. Regions that only have empty lines are skipped.
+    Regions are beautified in jobs processes if jobs is more than 1.
+    Raises ParserError if fails to parse.
+    """
+    if 1 < jobs:
+        for output in _beautified_regions_in_pool(string, options or beautifier.Options(), jobs):
+            yield output
+        return
+    layout_options = beautifier.layout_options(string, options)
+    for start, end, specification in parsed_regions(string, layout_options):
+        region_string = specification.to_string(layout_options)
+        if region_string:
+            yield region_string
+
+def iter_chunks(string, options = None, jobs = 1):
+    """
+    Yield the beautified string in parts, as beautified_regions with the line endings between them.
+    Raises ParserError if fails to parse, after yielding the regions before the error.
+    """
+    line_endings = beautifier.line_endings(string, options and options.line_endings)
+    for index, region_string in enumerate(beautified_regions(string, options, jobs)):
+        if index:
+            yield line_endings
+        yield region_string
+
+def write_to(stream, string, options = None, jobs = 1):
+    """
+    Write the beautified string to stream, one region at a time. Raises ParserError if fails to
+    parse, after writing the regions before the error.
+    """
+    for chunk in iter_chunks(string, options, jobs):
+        write_stream(stream, chunk)
+
+def _complete_regions(string, options):
+    """
+    Return the regions of string, which is the start of a document, that end where they would end
+    in the whole document. Raises ParserError if fails to lex, unless string ends in a quoted
+    string, which may continue after string.
+    """
+    try:
+        # The last region may continue after string
+        return regions(string, options)[:-1]
+    except ParserError as error:
+        if (error.position < len(string) and string[error.position] in "\"'`"
+              and lexer.quoted_string_end(string, error.position) == -1):
+            return []
+        raise
+
+def iter_stream_chunks(stream, options = None):
+    """
+    Yield the beautified string of the text in stream in parts, as iter_chunks, reading the stream
+    one line at a time and beautifying each region once it has been read. Only one region is kept
+    in memory at a time. Line endings are detected from the first line, and the positions of
+    errors are counted from the start of stream. Raises ParserError if fails to parse, after
+    yielding the regions before the error.
+    """
+    layout_options = None
+    lines = []
+    length = 0
+    # Length of the text that was last split to regions without finding a complete region. It is
+    # not split again until it has doubled, so that a long region is split a few times only.
+    split_length = 0
+    # Offset and line number of the start of lines in stream
+    offset = 0
+    start_line_number = 1
+    has_output = False
+    is_at_end = False
+    while not is_at_end:
+        line = stream.readline()
+        if line:
+            if layout_options is None:
+                layout_options = beautifier.layout_options(line, options)
+            lines.append(line)
+            length += len(line)
+            if length < split_length * 2:
+                continue
+            string = "".join(lines)
+            try:
+                string_regions = _complete_regions(string, layout_options)
+            except ParserError:
+                # Parse the text read so far, which raises the same error as parsing the whole
+                # stream would: the lexer error, or a syntax error before it
+                is_at_end = True
+                string_regions = [(0, len(string))]
+        else:
+            is_at_end = True
+            if layout_options is None:
+                layout_options = beautifier.layout_options("", options)
+            string = "".join(lines)
+            string_regions = [(0, len(string))]
+        for start, end in string_regions:
+            try:
+                region_string = _region_string(string, layout_options, start, end,
+                                               start_line_number)
+            except ParserError as error:
+                if error.line_number:
+                    error.position += offset
+                raise
+            if region_string:
+                if has_output:
+                    yield layout_options.line_endings
+                yield region_string
+                has_output = True
+            start_line_number += string.count("\n", start, end)
+        end = string_regions[-1][1] if string_regions else 0
+        lines = [string[end:]]
+        offset += end
+        length = split_length = len(lines[0])
+
+def beautified_string(string, options = None, jobs = 1):
+    """
+    Same as beautifier.beautified_string, but parses each region separately, in jobs processes if
+    jobs is more than 1
+    """
+    return "".join(iter_chunks(string, options, jobs))
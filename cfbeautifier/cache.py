@@ -0,0 +1,138 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from .util import replace_file
+import hashlib
+import json
+import os
+import time
+
+# Persistent record of file contents that are already beautified, so that cf-beautify can skip them.
+# The record is kept in a JSON file:
+#   "beautified": {content key: time of last use}
+#   "stats": {absolute path: [size, mtime, inode, content key]}
+# A content key is a hash of the file contents, the options and the beautifier version, so changing
+# any of them invalidates the entry.
+
+DEFAULT_MAX_ENTRY_COUNT = 100000
+
+def default_directory():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "cf-beautify")
+
+def beautifier_version():
+    "Hash of the source of the beautifier, so that a new version does not trust older results"
+    package_dir = os.path.dirname(os.path.realpath(__file__))
+    digest = hashlib.sha1()
+    for root, dir_names, file_names in os.walk(package_dir):
+        dir_names[:] = sorted(name for name in dir_names if name != "test")
+        for name in sorted(file_names):
+            if name.endswith(".py"):
+                with open(os.path.join(root, name), "rb") as file:
+                    digest.update(file.read())
+    return digest.hexdigest()
+
+def options_key(options):
+    return json.dumps(sorted(vars(options).items()))
+
+def file_stat(path):
+    stat = os.stat(path)
+    return [stat.st_size, getattr(stat, "st_mtime_ns", stat.st_mtime), stat.st_ino]
+
+class Cache(object):
+    """
+    Files that are already beautified with the given (beautifier.Options) options.
+    uses_stat: if True, a file whose size, modification time and inode have not changed since it
+               was found beautified is not even read. A file modified twice within the resolution
+               of the modification time without changing its size may then be skipped.
+    max_entry_count: the least recently used entries are removed above this count
+    hit_count, stat_hit_count, miss_count: how many files were found (by content or by stat) or not
+    """
+    def __init__(self, options, directory = None, uses_stat = False,
+                 max_entry_count = DEFAULT_MAX_ENTRY_COUNT):
+        self.path = os.path.join(directory or default_directory(), "beautified.json")
+        self.key_prefix = ("%s\n%s\n" % (beautifier_version(), options_key(options))).encode("utf-8")
+        self.uses_stat = uses_stat
+        self.max_entry_count = max_entry_count
+        self.hit_count = 0
+        self.stat_hit_count = 0
+        self.miss_count = 0
+        self.last_use_by_key = {}
+        self.stat_by_path = {}
+        # Content keys of the files looked up, so that they need not be read again when added
+        self.key_by_path = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as file:
+                record = json.load(file)
+            self.last_use_by_key = record["beautified"]
+            self.stat_by_path = record["stats"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            # Missing or broken cache is the same as empty
+            pass
+
+    def _content_key(self, path):
+        digest = hashlib.sha1(self.key_prefix)
+        with open(path, "rb") as file:
+            digest.update(file.read())
+        return digest.hexdigest()
+
+    def is_beautified(self, path):
+        "True if the file at path is known to be beautified. Counts hits and misses."
+        absolute_path = os.path.abspath(path)
+        now = time.time()
+        if self.uses_stat:
+            stat = self.stat_by_path.get(absolute_path)
+            if stat and stat[3] in self.last_use_by_key and stat[:3] == file_stat(path):
+                self.last_use_by_key[stat[3]] = now
+                self.stat_hit_count += 1
+                return True
+        key = self._content_key(path)
+        if key in self.last_use_by_key:
+            self.last_use_by_key[key] = now
+            if self.uses_stat:
+                self.stat_by_path[absolute_path] = file_stat(path) + [key]
+            self.hit_count += 1
+            return True
+        self.key_by_path[path] = key
+        self.miss_count += 1
+        return False
+
+    def add_beautified(self, path, is_rewritten = False):
+        """
+        Record that the file at path is beautified. is_rewritten: True if the file was written
+        after it was looked up, so that it must be read again.
+        """
+        key = self.key_by_path.pop(path, None)
+        if is_rewritten or not key:
+            key = self._content_key(path)
+        self.last_use_by_key[key] = time.time()
+        if self.uses_stat:
+            self.stat_by_path[os.path.abspath(path)] = file_stat(path) + [key]
+
+    def _evict(self):
+        if self.max_entry_count < len(self.last_use_by_key):
+            keys = sorted(self.last_use_by_key, key = self.last_use_by_key.get, reverse = True)
+            self.last_use_by_key = dict((key, self.last_use_by_key[key])
+                                        for key in keys[:self.max_entry_count])
+        self.stat_by_path = dict((path, stat) for path, stat in self.stat_by_path.items()
+                                 if stat[3] in self.last_use_by_key)
+
+    def save(self):
+        "Write the cache. Failing to write it is ignored, since the cache is just an optimization."
+        self._evict()
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Replaced, so that a concurrent run never reads half a file
+            replace_file(self.path, lambda file: json.dump({ "beautified" : self.last_use_by_key,
+                                                             "stats" : self.stat_by_path },
+                                                           file))
+        except (IOError, OSError):
+            pass
+
+    def summary(self):
+        return ("Cache: %d hits (%d by file metadata), %d misses"
+                    % (self.hit_count + self.stat_hit_count, self.stat_hit_count, self.miss_count))
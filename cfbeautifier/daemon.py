@@ -0,0 +1,211 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+from . import beautifier
+from .util import ParserError
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+
+if sys.version_info[0] < 3:
+    import SocketServer as socketserver
+else:
+    import socketserver
+
+# A daemon keeps the parser built, so that beautifying a string does not need to start Python and
+# build the parser. The client and the daemon talk over a Unix socket, one request per connection:
+# the client sends a JSON object with "string" and "options" on one line, and the daemon answers
+# with a JSON object that has either "output" or "error": [fragment, line number, position] if
+# the string fails to parse, or a message if the request could not be handled. A connection that
+# sends nothing (e.g., a check that the daemon is running) gets no answer.
+#
+# The client sends its buffers only to a daemon of the same user, since another user could
+# otherwise create the socket first, read the buffers and answer with anything. The socket is
+# accessible only by its user, and the default socket outside $XDG_RUNTIME_DIR is in a directory
+# that only its user can access.
+
+DEFAULT_CACHE_SIZE = 100
+# Seconds that the client waits for the daemon to answer before beautifying in its own process
+DEFAULT_TIMEOUT = 60
+
+def _user_id():
+    return os.getuid() if hasattr(os, "getuid") else 0 # No Unix sockets on Windows anyway
+
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir: # Accessible only by the user
+        return os.path.join(runtime_dir, "cf-beautify-%d.sock" % _user_id())
+    return os.path.join(tempfile.gettempdir(), "cf-beautify-%d" % _user_id(), "daemon.sock")
+
+def _make_socket_directory(socket_path):
+    """
+    Create the directory of socket_path, accessible only by the user, if it does not exist. Raises
+    ValueError if the directory of the default socket is accessible by others.
+    """
+    directory = os.path.dirname(socket_path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    if socket_path == default_socket_path():
+        directory_stat = os.lstat(directory)
+        if (not stat.S_ISDIR(directory_stat.st_mode) or directory_stat.st_uid != _user_id()
+              or directory_stat.st_mode & 0o077):
+            raise ValueError("%s must be a directory that only its owner can access" % directory)
+
+class LruCache(object):
+    "Keeps size most recently used values. Thread safe."
+    def __init__(self, size):
+        self.size = size
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.values.pop(key, None)
+            if value is not None:
+                self.values[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.values.pop(key, None)
+            self.values[key] = value
+            while self.size < len(self.values):
+                self.values.popitem(last = False)
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line.strip():
+            return
+        try:
+            request = json.loads(line.decode("utf-8"))
+            response = self.server.response(request["string"], request["options"])
+        except Exception as error:
+            response = { "error" : "Cannot handle request: %r" % error }
+        try:
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+        except socket.error: # Client is gone
+            pass
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    "Beautifies requests in threads, and keeps the responses to cache_size recent requests"
+    daemon_threads = True
+
+    def __init__(self, socket_path, cache_size = DEFAULT_CACHE_SIZE):
+        _make_socket_directory(socket_path)
+        if os.path.exists(socket_path):
+            if _is_listening(socket_path):
+                raise ValueError("Daemon is already running at %s" % socket_path)
+            os.remove(socket_path) # Left by a daemon that did not exit cleanly
+        # Build the parser before serving
+        beautifier.beautified_string("")
+        self.responses = LruCache(cache_size)
+        socketserver.UnixStreamServer.__init__(self, socket_path, _RequestHandler)
+
+    def server_bind(self):
+        # Create the socket accessible only by the user, rather than restrict it after it exists
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+    def response(self, string, options_dict):
+        key = hashlib.sha1((json.dumps(sorted(options_dict.items())) + "\n" + string)
+                               .encode("utf-8")).hexdigest()
+        response = self.responses.get(key)
+        if response is None:
+            options = beautifier.options_from_dict(options_dict)
+            try:
+                response = { "output" : beautifier.beautified_string(string, options) }
+            except ParserError as error:
+                response = { "error" : [error.fragment, error.line_number, error.position] }
+            self.responses.put(key, response)
+        return response
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+def serve(socket_path = None, cache_size = DEFAULT_CACHE_SIZE):
+    "Serve until interrupted"
+    server = Server(socket_path or default_socket_path(), cache_size)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def _is_listening(socket_path):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        connection.close()
+
+def _is_daemon_of_user(connection, socket_path):
+    "True if the daemon connected to at socket_path runs as this user"
+    if hasattr(socket, "SO_PEERCRED"): # Linux
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                            struct.calcsize("3i"))
+        return struct.unpack("3i", credentials)[1] == _user_id()
+    return os.stat(socket_path).st_uid == _user_id()
+
+def _request(socket_path, request, timeout):
+    """
+    Return the response, or None if there is no daemon of this user, or it does not answer within
+    timeout seconds
+    """
+    if not hasattr(socket, "AF_UNIX"): # Windows
+        return None
+    socket_path = socket_path or default_socket_path()
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        if os.stat(socket_path).st_uid != _user_id():
+            return None
+        connection.connect(socket_path)
+        if not _is_daemon_of_user(connection, socket_path):
+            return None
+        connection.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        chunks = []
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return json.loads(b"".join(chunks).decode("utf-8"))
+    except (socket.error, OSError, ValueError):
+        # Daemon is not running, or failed to answer
+        return None
+    finally:
+        connection.close()
+
+def beautified_string(string, options = None, socket_path = None, timeout = DEFAULT_TIMEOUT):
+    """
+    Beautify in the daemon at socket_path (default_socket_path() by default), or in this process if
+    the daemon is not running, is not of this user, does not answer within timeout seconds or
+    cannot handle the request. Raises ParserError if fails to parse.
+    """
+    options = options or beautifier.Options()
+    response = _request(socket_path, { "string" : string, "options" : vars(options) }, timeout)
+    if response is None or not isinstance(response.get("error", []), list):
+        return beautifier.beautified_string(string, options)
+    if "error" in response:
+        fragment, line_number, position = response["error"]
+        raise ParserError(fragment, line_number, string, position)
+    return response["output"]
@@ -0,0 +1,271 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+# Document algebra for layouting. Nodes describe their output as a tree of documents, which does not
+# depend on where in the page the node is, and render() decides the layout in a single pass.
+#
+# A line break starts a line that is indented to the nesting level at the line break, plus the
+# indent of the first Text on that line that has one. The alternatives of a choice (IfFits or Group)
+# are measured as if they started at the current nesting level. An alternative fits if none of its
+# lines, resolved with the same rules, go past the page width. End-of-line comments are not measured.
+
+class Document(object):
+    def __repr__(self):
+        return self.__class__.__name__
+
+class Text(Document):
+    def __init__(self, string, indent = None):
+        self.string = string
+        # If the line is started with this Text (or no Text before this on the line has an indent),
+        # the line is indented this much relative to the nesting level at the line break
+        self.indent = indent
+    def __repr__(self):
+        return 'Text("%s", %s)' % (self.string, str(self.indent))
+
+class LineBreak(Document):
+    pass
+
+class SoftLine(Document):
+    "Line break if the enclosing Group is broken, otherwise flat_string"
+    def __init__(self, flat_string):
+        self.flat_string = flat_string
+
+class EndComment(Document):
+    "Appended to the end of the line, after any text that follows. Is not measured."
+    def __init__(self, string):
+        self.string = string
+
+class Nest(Document):
+    "Line breaks in document are indented by indent more than the current nesting level"
+    def __init__(self, indent, document):
+        self.indent = indent
+        self.document = document
+
+class Concat(Document):
+    def __init__(self, *documents):
+        self.documents = documents
+
+class Group(Document):
+    "SoftLines in the document (but not in nested Groups) are flat if they fit, otherwise broken"
+    def __init__(self, document):
+        self.document = document
+
+class IfFits(Document):
+    """
+    The first alternative that fits, or the last alternative if none fits. An alternative whose
+    first line is known to be at least min_widths[index] wide is skipped without measuring it.
+    """
+    def __init__(self, alternatives, min_widths = None):
+        self.alternatives = alternatives
+        self.min_widths = min_widths
+
+EMPTY = Concat()
+
+def concat(*documents):
+    "Return Concat, or the only document if there is just one"
+    if len(documents) == 1:
+        return documents[0]
+    return Concat(*documents)
+
+def if_fits(alternatives, min_widths = None):
+    "Return IfFits, or the only alternative if there is just one"
+    if len(alternatives) == 1:
+        return alternatives[0]
+    return IfFits(alternatives, min_widths)
+
+def last_line_width(document):
+    """
+    Return the width (including indent) of the last line of a document that has no choices,
+    measured from nesting level 0
+    """
+    # [nesting level at line break (None on first line), indent, width]
+    state = [None, None, 0]
+    def walk(document, nest):
+        if isinstance(document, Text):
+            if state[1] == None:
+                state[1] = document.indent
+            state[2] += len(document.string)
+        elif isinstance(document, LineBreak):
+            state[:] = [nest, None, 0]
+        elif isinstance(document, Nest):
+            walk(document.document, nest + document.indent)
+        elif isinstance(document, Concat):
+            for child in document.documents:
+                walk(child, nest)
+        elif not isinstance(document, EndComment):
+            raise ValueError("Cannot measure choices without page width: %s" % document)
+    walk(document, 0)
+    return (state[0] or 0) + (state[1] or 0) + state[2]
+
+FLAT = "flat"
+BROKEN = "broken"
+
+# Summary of the lines of a document at a given nesting level is a tuple:
+#   (indent of first line, width of first line,
+#    nesting level at the last line break or None if no line breaks,
+#    indent of last line, width of last line,
+#    max width of other lines)
+# Widths of the first and the last line cover only the part in the document. Indent is None if no
+# Text has set it (yet). TOO_WIDE is used instead of the tuple when any line is known not to fit.
+TOO_WIDE = None
+
+class Layout(object):
+    "Decides the layout of documents for a page width. Memoizes decisions by nesting level."
+    def __init__(self, page_width):
+        self.page_width = page_width
+        self.summaries = {}
+        self.choices = {}
+
+    def _joined_summary(self, first, second):
+        if first is TOO_WIDE or second is TOO_WIDE:
+            return TOO_WIDE
+        (first_indent, first_width, last_nest, last_indent, last_width, max_width) = first
+        (second_first_indent, second_first_width,
+         second_last_nest, second_last_indent, second_last_width, second_max_width) = second
+        if last_nest is None: # first has just one line, which continues to the second
+            indent = first_indent if first_indent is not None else second_first_indent
+            width = first_width + second_first_width
+            if second_last_nest is None:
+                summary = (indent, width, None, None, 0, 0)
+            else:
+                summary = (indent, width, second_last_nest, second_last_indent, second_last_width,
+                           second_max_width)
+        else:
+            indent = last_indent if last_indent is not None else second_first_indent
+            width = last_width + second_first_width
+            if second_last_nest is None:
+                summary = (first_indent, first_width, last_nest, indent, width, max_width)
+            else:
+                summary = (first_indent, first_width,
+                           second_last_nest, second_last_indent, second_last_width,
+                           max(max_width, last_nest + (indent or 0) + width, second_max_width))
+        return self._checked_summary(summary)
+
+    def _checked_summary(self, summary):
+        "Return TOO_WIDE if some line in the summary cannot fit, wherever the document is"
+        (first_indent, first_width, last_nest, last_indent, last_width, max_width) = summary
+        if (self.page_width < first_width
+            or (last_nest is not None
+                and (self.page_width < max_width
+                     # Lines only get longer when something is appended to them
+                     or self.page_width < last_nest + (last_indent or 0) + last_width))):
+            return TOO_WIDE
+        return summary
+
+    def _fits(self, summary, nest):
+        return (summary is not TOO_WIDE
+                and nest + (summary[0] or 0) + summary[1] <= self.page_width)
+
+    def summary(self, document, nest, mode):
+        if isinstance(document, Text):
+            return self._checked_summary((document.indent, len(document.string), None, None, 0, 0))
+        if isinstance(document, EndComment):
+            return (None, 0, None, None, 0, 0)
+        if isinstance(document, LineBreak):
+            return (None, 0, nest, None, 0, 0)
+        if isinstance(document, SoftLine):
+            if mode == BROKEN:
+                return (None, 0, nest, None, 0, 0)
+            return self._checked_summary((None, len(document.flat_string), None, None, 0, 0))
+        if isinstance(document, Nest):
+            return self.summary(document.document, nest + document.indent, mode)
+
+        key = (document, nest, mode)
+        try:
+            return self.summaries[key]
+        except KeyError:
+            pass
+        if isinstance(document, Concat):
+            summary = (None, 0, None, None, 0, 0)
+            for child in document.documents:
+                # Stops as soon as some line is too wide
+                summary = self._joined_summary(summary, self.summary(child, nest, mode))
+                if summary is TOO_WIDE:
+                    break
+        elif isinstance(document, Group):
+            summary = self.summary(document.document, nest, self.group_mode(document, nest))
+        else:
+            summary = self.summary(self.chosen_alternative(document, nest, mode), nest, mode)
+        self.summaries[key] = summary
+        return summary
+
+    def group_mode(self, group, nest):
+        key = (group, nest)
+        mode = self.choices.get(key)
+        if mode is None:
+            if self._fits(self.summary(group.document, nest, FLAT), nest):
+                mode = FLAT
+            else:
+                mode = BROKEN
+            self.choices[key] = mode
+        return mode
+
+    def chosen_alternative(self, if_fits, nest, mode):
+        key = (if_fits, nest, mode)
+        index = self.choices.get(key)
+        if index is None:
+            alternatives = if_fits.alternatives
+            last_index = len(alternatives) - 1
+            for index, alternative in enumerate(alternatives):
+                if index == last_index:
+                    break
+                if (if_fits.min_widths
+                    and self.page_width < nest + if_fits.min_widths[index]):
+                    continue
+                if self._fits(self.summary(alternative, nest, mode), nest):
+                    break
+            self.choices[key] = index
+        return if_fits.alternatives[index]
+
+class _Lines(object):
+    "Collects the rendered lines"
+    def __init__(self):
+        self.lines = []
+        self.texts = []
+        self.end_comments = []
+        self.nest = 0
+        self.indent = None
+    def add_text(self, string, indent):
+        if self.indent is None:
+            self.indent = indent
+        self.texts.append(string)
+    def end_line(self):
+        string = "".join(self.texts) + "".join(self.end_comments)
+        indent = self.nest + (self.indent or 0)
+        # No indent for empty lines
+        self.lines.append(" " * indent + string if string else string)
+    def line_break(self, nest):
+        self.end_line()
+        self.texts = []
+        self.end_comments = []
+        self.nest = nest
+        self.indent = None
+
+def render(document, page_width):
+    "Return the lines of the document, as strings"
+    layout = Layout(page_width)
+    lines = _Lines()
+    def walk(document, nest, mode):
+        if isinstance(document, Text):
+            lines.add_text(document.string, document.indent)
+        elif isinstance(document, Concat):
+            for child in document.documents:
+                walk(child, nest, mode)
+        elif isinstance(document, Nest):
+            walk(document.document, nest + document.indent, mode)
+        elif isinstance(document, LineBreak):
+            lines.line_break(nest)
+        elif isinstance(document, EndComment):
+            lines.end_comments.append(document.string)
+        elif isinstance(document, SoftLine):
+            if mode == BROKEN:
+                lines.line_break(nest)
+            else:
+                lines.add_text(document.flat_string, None)
+        elif isinstance(document, Group):
+            walk(document.document, nest, layout.group_mode(document, nest))
+        else:
+            walk(layout.chosen_alternative(document, nest, mode), nest, mode)
+    walk(document, 0, BROKEN)
+    lines.end_line()
+    return lines.lines
@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+from . import beautifier
+from .util import ParserError, replace_file
+from .version_abstraction import string_from_file, write_stream
+import multiprocessing
+import os
+
+class FileResult(object):
+    """
+    Result of beautifying a file
+    output: the beautified string, or None if it was not requested
+    is_changed: True if the beautified string is different from the file
+    error: error message if the file could not be beautified, otherwise None
+    """
+    def __init__(self, path, output = None, is_changed = False, error = None):
+        self.path = path
+        self.output = output
+        self.is_changed = is_changed
+        self.error = error
+
+def write_chunks(path, chunks):
+    """
+    Write the strings in chunks to the file in path. The file is replaced only once all of chunks
+    is written, so if iterating chunks raises (e.g., ParserError), the file is left as it was.
+    """
+    def write(file):
+        for chunk in chunks:
+            write_stream(file, chunk)
+    # Replace the file that a link points to, rather than the link
+    path = os.path.realpath(path)
+    if os.access(os.path.dirname(path), os.W_OK):
+        replace_file(path, write)
+    else:
+        # Cannot create files in the directory, so write in place once all chunks are ready
+        chunks = list(chunks)
+        with open(path, 'w') as file:
+            write(file)
+
+def write_file(path, output):
+    write_chunks(path, [output])
+
+def beautify_file(path, options, writes_changes = True, returns_output = False,
+                  beautify_fn = beautifier.beautified_string):
+    """
+    Beautify the file in path and return FileResult.
+    writes_changes: if True, the file is overwritten if beautifying changed it
+    returns_output: if True, the beautified string is in the result
+    beautify_fn: beautifies a string with options, like beautifier.beautified_string
+    """
+    input = string_from_file(path)
+    try:
+        output = beautify_fn(input, options)
+    except ParserError as error:
+        return FileResult(path, error = str(error))
+    is_changed = input != output
+    if writes_changes and is_changed:
+        write_file(path, output)
+    return FileResult(path,
+                      output = output if returns_output else None,
+                      is_changed = is_changed)
+
+def _beautify_file_in_worker(args):
+    "Return the FileResult of beautify_file with the arguments in args"
+    return beautify_file(*args)
+
+# Inputs smaller than this are beautified in one process by default, since starting a process pool
+# takes longer than it saves
+MIN_PARALLEL_SIZE = 1024 * 1024
+
+def default_job_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def job_count(jobs, size):
+    """
+    Return jobs, or if it is None, the number of processes to beautify size bytes of input in:
+    default_job_count() for large inputs, and 1 for small ones
+    """
+    if jobs is not None:
+        return jobs
+    return default_job_count() if MIN_PARALLEL_SIZE <= size else 1
+
+def _beautified_files(paths, options, writes_changes, returns_output, beautify_fn, jobs):
+    def args(path):
+        return (path, options, writes_changes, returns_output, beautify_fn)
+    if jobs <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield _beautify_file_in_worker(args(path))
+        return
+
+    pool = multiprocessing.Pool(min(jobs, len(paths)))
+    try:
+        result_by_path = {}
+        for path in sorted(set(paths), key = os.path.getsize, reverse = True):
+            result_by_path[path] = pool.apply_async(_beautify_file_in_worker, (args(path),))
+        pool.close()
+        for path in paths:
+            yield result_by_path[path].get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def beautify_files(paths, options, writes_changes = True, returns_output = False,
+                   beautify_fn = beautifier.beautified_string, jobs = 1, cache = None):
+    """
+    Beautify the files in jobs processes, and yield FileResult for each path, in the order of paths.
+    The largest files are beautified first, so that a large file does not delay the end.
+    beautify_fn: as in beautify_file. Must be picklable if jobs is more than 1.
+    cache: if given (cache.Cache), files that it knows to be beautified are skipped, and files found
+           to be beautified or rewritten beautified are added to it. The files are looked up
+           before any is beautified, in this process, so each file not found by its stat is read
+           and hashed here one after another. That is fast compared to beautifying, but is not
+           done in parallel.
+    """
+    if cache:
+        cached_paths = set(filter(cache.is_beautified, paths))
+    else:
+        cached_paths = set()
+    results = _beautified_files([path for path in paths if not path in cached_paths],
+                                options, writes_changes, returns_output, beautify_fn, jobs)
+    for path in paths:
+        if path in cached_paths:
+            # Beautified file is the same as its beautified string
+            yield FileResult(path, output = string_from_file(path) if returns_output else None)
+        else:
+            result = next(results)
+            if cache and not result.error and (writes_changes or not result.is_changed):
+                cache.add_beautified(path, is_rewritten = result.is_changed)
+            yield result
@@ -1,7 +1,9 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 from .util import ParserError
+from .version_abstraction import text_class
 from .ply import lex
+import re
 
 t_ARROW = r"->"
 t_ASSIGN = r"=>"
@@ -18,8 +20,38 @@ keywords = {
    "bundle" : "BUNDLE",
 }
 
+def quoted_string_end(string, start):
+    """
+    Return the position after the quoted string that starts at start, or -1 if it does not end.
+    In "..." and '...', a backslash escapes the next character. `...` has no escapes.
+    """
+    quote = string[start]
+    if quote == "`":
+        end = string.find(quote, start + 1)
+        return -1 if end == -1 else end + 1
+    # Jumps from backslash to backslash until the next quote, so each character is looked at once
+    pos = start + 1
+    quote_pos = string.find(quote, pos)
+    while quote_pos != -1:
+        backslash_pos = string.find("\\", pos, quote_pos)
+        if backslash_pos == -1:
+            return quote_pos + 1
+        pos = backslash_pos + 2
+        if quote_pos < pos: # Escaped
+            quote_pos = string.find(quote, pos)
+    return -1
+
 def t_QSTRING(t):
-    r"\"((\\(.|\n))|[^\"\\])*\"|\'((\\(.|\n))|[^'\\])*\'|`[^`]*`"
+    r"[\"'`]"
+    # The string is found by quoted_string_end, which takes linear time, unlike a regular
+    # expression with an alternative for each character
+    string = t.lexer.lexdata
+    end = quoted_string_end(string, t.lexpos)
+    if end == -1:
+        # As t_error
+        raise ParserError(string[t.lexpos:], t.lineno, string, t.lexpos)
+    t.value = string[t.lexpos:end]
+    t.lexer.lexpos = end
     t.lexer.lineno += t.value.count("\n")
     return t
 
@@ -63,7 +95,100 @@ tokens = ([token for token in [id[2:] for id in globals().keys() if id.startswit
                if token.upper() == token] +
            list(keywords.values()))
 
+# Building the lexer compiles the rules to a regular expression, so it is done only once, and each
+# document is lexed with a clone
+master_lexer = lex.lex()
+
 def lexer():
-    the_lex = lex.lex()
+    "Return a new lexer, that has not lexed anything"
+    the_lex = master_lexer.clone()
+    the_lex.lineno = 1
     the_lex.comments = []
     return the_lex
+
+# Scanner is an alternative to the lexer of ply.lex, which calls a function for each token, and
+# matches white space and line breaks as tokens of their own. Scanner matches the white space,
+# line breaks and the next token with one regular expression, and gives the same tokens.
+
+# Rules in the order ply.lex tries them: functions in the order they are defined, then strings
+# from the longest regular expression (t_space and t_newline are part of SKIPPED_REGEX)
+SCANNER_RULES = [("QSTRING", t_QSTRING.__doc__),
+                 ("CLASS", t_CLASS.__doc__),
+                 ("SYMBOL", t_SYMBOL.__doc__),
+                 ("PROMISE_TYPE", t_PROMISE_TYPE.__doc__),
+                 ("IDSYNTAX", t_IDSYNTAX.__doc__),
+                 ("comment", t_comment.__doc__)] + \
+                sorted([(name[2:], value) for name, value in list(globals().items())
+                        if name.startswith("t_") and isinstance(value, text_class)],
+                       key = lambda rule: len(rule[1]), reverse = True)
+
+# Not [ \t]+ in the group, which would backtrack exponentially before a character that fails to lex
+SKIPPED_REGEX = r"(?:[ \t]|\r?\n)*"
+
+# Verbose, as in ply.lex
+SCANNER_REGEX = re.compile(SKIPPED_REGEX
+                           + "(?:%s|(?P<end>\\Z))" % "|".join("(?P<%s>%s)" % rule
+                                                               for rule in SCANNER_RULES),
+                           re.VERBOSE)
+SKIPPED = re.compile(SKIPPED_REGEX, re.VERBOSE)
+
+class Scanner(object):
+    "Has the attributes and methods of the lexer of ply.lex that the parser uses"
+    def __init__(self):
+        self.lexdata = None
+        self.lexpos = 0
+        self.lineno = 1
+        self.comments = []
+    def input(self, string):
+        self.lexdata = string
+        self.lexpos = 0
+    def token(self):
+        "Return the next token, or None at the end. Raises ParserError if fails to lex."
+        string = self.lexdata
+        pos = self.lexpos
+        if len(string) <= pos:
+            # As ply.lex
+            self.lexpos += 1
+            return None
+        while True:
+            match = SCANNER_REGEX.match(string, pos)
+            if not match:
+                start = SKIPPED.match(string, pos).end()
+                self.lineno += string.count("\n", pos, start)
+                raise ParserError(string[start:], self.lineno, string, start)
+            type = match.lastgroup
+            start = match.start(type)
+            self.lineno += string.count("\n", pos, start)
+            pos = match.end()
+            if type == "end":
+                self.lexpos = pos + 1
+                return None
+            token = lex.LexToken()
+            token.type = type
+            token.value = match.group(type)
+            token.lineno = self.lineno
+            token.lexpos = start
+            token.lexer = self
+            if type == "comment":
+                token.value = token.value.rstrip()
+                self.comments.append(token)
+                continue
+            if type == "QSTRING":
+                end = quoted_string_end(string, start)
+                if end == -1:
+                    raise ParserError(string[start:], self.lineno, string, start)
+                token.value = string[start:end]
+                pos = end
+                self.lineno += token.value.count("\n")
+            elif type == "IDSYNTAX":
+                token.type = keywords.get(token.value, type)
+            self.lexpos = pos
+            return token
+
+def scanner():
+    "Return a new Scanner, that has not scanned anything"
+    return Scanner()
+
+def lexer_for(options):
+    "Return a new lexer of the kind that options (beautifier.Options or structure.Options) select"
+    return scanner() if options.lexer == "scanner" else lexer()
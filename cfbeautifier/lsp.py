@@ -0,0 +1,262 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+from . import beautifier
+from . import session
+from .util import ParserError, line_offsets
+import json
+import sys
+import traceback
+
+# Language Server Protocol server, run with: cf-beautify --lsp
+#
+# Supports incremental document sync, textDocument/formatting, textDocument/rangeFormatting and
+# syntax errors as diagnostics. The options given in initializationOptions (names as in
+# beautifier.Options) override the options given to the server. Positions are counted in
+# characters, which is the same as UTF-16 code units the protocol uses, unless the document has
+# characters outside the Basic Multilingual Plane. An error in handling a message is answered with
+# a JSON-RPC error, or logged to stderr for a notification, and the server keeps serving.
+
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+SYNC_INCREMENTAL = 2
+SEVERITY_ERROR = 1
+
+def position(text, offset):
+    "Return LSP position of offset in text"
+    line = text.count("\n", 0, offset)
+    return { "line" : line, "character" : offset - (text.rfind("\n", 0, offset) + 1) }
+
+class Document(object):
+    "Open document, and its Session, or the ParserError if it could not be parsed"
+    def __init__(self, text, options):
+        self.options = options
+        self.session = None
+        self.error = None
+        self.set_text(text)
+        self.parse()
+
+    def set_text(self, text):
+        self.text = text
+        self.offsets = line_offsets(text)
+
+    def parse(self, start = None, end = None, string = None):
+        "Parse the text, incrementally if it was parsed before and changed by the given edit"
+        try:
+            if self.session:
+                self.session.edit(start, end, string)
+            else:
+                self.session = session.Session(self.text, self.options)
+            self.error = None
+        except ParserError as error:
+            self.error = error
+
+    def line_end(self, line):
+        "Return the offset of the line ending of line (0 based)"
+        if len(self.offsets) <= line + 1:
+            return len(self.text)
+        end = self.offsets[line + 1] - 1
+        if 0 < end and self.text[end - 1] == "\r":
+            return end - 1
+        return end
+
+    def offset(self, lsp_position):
+        "Return the offset of lsp_position, at the end of the line if character is past it"
+        line = lsp_position["line"]
+        if len(self.offsets) <= line:
+            return len(self.text)
+        return min(self.offsets[line] + lsp_position["character"], self.line_end(line))
+
+    def change(self, content_changes):
+        for change in content_changes:
+            if "range" in change:
+                start = self.offset(change["range"]["start"])
+                end = self.offset(change["range"]["end"])
+            else:
+                start, end = 0, len(self.text)
+            self.set_text(self.text[:start] + change["text"] + self.text[end:])
+            self.parse(start, end, change["text"])
+
+    def diagnostics(self):
+        if not self.error:
+            return []
+        if self.error.line_number: # 0 at the end of the file
+            start = self.error.position
+            # Fragment of a lexer error is the rest of the input
+            end = min(start + len(self.error.fragment),
+                      self.line_end(self.text.count("\n", 0, start)))
+        else:
+            start = end = len(self.text)
+        return [{ "range" : { "start" : position(self.text, start),
+                              "end" : position(self.text, end) },
+                  "severity" : SEVERITY_ERROR,
+                  "source" : "cf-beautify",
+                  "message" : str(self.error) }]
+
+    def edits(self, start, end, new_text):
+        "Return TextEdits that replace the text between offsets start and end by new_text"
+        if self.text[start:end] == new_text:
+            return []
+        return [{ "range" : { "start" : position(self.text, start),
+                              "end" : position(self.text, end) },
+                  "newText" : new_text }]
+
+    def formatting_edits(self):
+        if self.error:
+            return None
+        return self.edits(0, len(self.text), self.session.to_string())
+
+    def range_formatting_edits(self, lsp_range):
+        """
+        Return edits that beautify the top level items (bundles, bodies and standalone comments)
+        that are at least partly in lsp_range, with the empty lines before them
+        """
+        if self.error:
+            return None
+        start = self.offset(lsp_range["start"])
+        end = self.offset(lsp_range["end"])
+        all_regions = self.session.regions
+        indexes = [index for index, region in enumerate(all_regions)
+                   if region.items and region.start <= end and start < region.end]
+        if not indexes:
+            return []
+        regions = all_regions[indexes[0]:indexes[-1] + 1]
+        line_endings = self.session.layout_options.line_endings
+        is_first = not any(region.items for region in all_regions[:indexes[0]])
+        # Items are separated by an empty line, and the last line ends with a line break
+        new_text = ("" if is_first else line_endings) + (line_endings * 2).join(
+                        self.session.item_strings(regions)) + line_endings
+        return self.edits(regions[0].start, regions[-1].end, new_text)
+
+class RequestError(Exception):
+    "Error to answer a request with, code as in JSON-RPC"
+    def __init__(self, code, message):
+        super(RequestError, self).__init__(message)
+        self.code = code
+
+class Server(object):
+    def __init__(self, input, output, options = None, log = None):
+        "input and output are binary streams, and errors are logged to log (stderr by default)"
+        self.input = input
+        self.output = output
+        self.log = log or sys.stderr
+        self.options = options or beautifier.Options()
+        self.documents = {}
+        self.is_running = True
+
+    def read_message(self):
+        "Return the message, or None at the end of input"
+        content_length = None
+        while True:
+            line = self.input.readline()
+            if not line:
+                return None
+            line = line.decode("ascii").strip()
+            if not line:
+                break
+            name, value = line.split(":", 1)
+            if name.strip().lower() == "content-length":
+                content_length = int(value)
+        return json.loads(self.input.read(content_length).decode("utf-8"))
+
+    def write_message(self, message):
+        message["jsonrpc"] = "2.0"
+        body = json.dumps(message).encode("utf-8")
+        self.output.write(("Content-Length: %d\r\n\r\n" % len(body)).encode("ascii"))
+        self.output.write(body)
+        self.output.flush()
+
+    def notify(self, method, params):
+        self.write_message({ "method" : method, "params" : params })
+
+    def publish_diagnostics(self, uri):
+        document = self.documents.get(uri)
+        self.notify("textDocument/publishDiagnostics",
+                    { "uri" : uri, "diagnostics" : document.diagnostics() if document else [] })
+
+    def handle(self, message):
+        "Return the result of the message. Raises RequestError if fails."
+        method = message.get("method")
+        handler = getattr(self, "on_" + (method or "").replace("/", "_").replace("$", "_"), None)
+        if not handler:
+            raise RequestError(METHOD_NOT_FOUND, "Unknown method: %s" % method)
+        try:
+            return handler(message.get("params"))
+        except RequestError:
+            raise
+        except Exception as error:
+            print(traceback.format_exc(), file = self.log)
+            raise RequestError(INTERNAL_ERROR, "Internal error: %r" % error)
+
+    def serve(self):
+        "Serve until exit notification or the end of input"
+        while self.is_running:
+            message = self.read_message()
+            if message is None:
+                break
+            if "method" not in message: # Response to a request of the server
+                continue
+            try:
+                result = self.handle(message)
+            except RequestError as error:
+                if "id" in message:
+                    self.write_message({ "id" : message["id"],
+                                         "error" : { "code" : error.code,
+                                                     "message" : str(error) } })
+                elif error.code != METHOD_NOT_FOUND: # Unknown notifications are ignored
+                    print("%s: %s" % (message.get("method"), error), file = self.log)
+                continue
+            if "id" in message:
+                self.write_message({ "id" : message["id"], "result" : result })
+
+    def document(self, params):
+        "Raises RequestError if the document of params is not open"
+        uri = params["textDocument"]["uri"]
+        if uri not in self.documents:
+            raise RequestError(INVALID_PARAMS, "Unknown document: %s" % uri)
+        return self.documents[uri]
+
+    def on_initialize(self, params):
+        options = dict(vars(self.options))
+        options.update((params or {}).get("initializationOptions") or {})
+        self.options = beautifier.options_from_dict(options)
+        return { "capabilities" : { "textDocumentSync" : { "openClose" : True,
+                                                           "change" : SYNC_INCREMENTAL },
+                                    "documentFormattingProvider" : True,
+                                    "documentRangeFormattingProvider" : True },
+                 "serverInfo" : { "name" : "cf-beautify" } }
+
+    def on_shutdown(self, params):
+        return None
+
+    def on_exit(self, params):
+        self.is_running = False
+
+    def on_textDocument_didOpen(self, params):
+        text_document = params["textDocument"]
+        self.documents[text_document["uri"]] = Document(text_document["text"], self.options)
+        self.publish_diagnostics(text_document["uri"])
+
+    def on_textDocument_didChange(self, params):
+        self.document(params).change(params["contentChanges"])
+        self.publish_diagnostics(params["textDocument"]["uri"])
+
+    def on_textDocument_didClose(self, params):
+        uri = params["textDocument"]["uri"]
+        self.documents.pop(uri, None)
+        self.publish_diagnostics(uri)
+
+    def on_textDocument_formatting(self, params):
+        return self.document(params).formatting_edits()
+
+    def on_textDocument_rangeFormatting(self, params):
+        return self.document(params).range_formatting_edits(params["range"])
+
+def serve(options = None):
+    "Serve on stdin and stdout"
+    # Binary streams, since Content-Length is in bytes
+    Server(getattr(sys.stdin, "buffer", sys.stdin),
+           getattr(sys.stdout, "buffer", sys.stdout),
+           options).serve()
@@ -7,6 +7,7 @@ from . import structure
 from . import util
 from .version_abstraction import text_class
 from .ply import yacc
+import copy
 import os
 import re
 import sys
@@ -192,32 +193,38 @@ def declare_grammar():
         # Add p_ prefix and clean up characters that are invalid in a function
         function_name = "p_%s" % re.sub(r"[:| \n]+", "_", expression)
         def fn(p):
-            p_size = len(p)
-            if 1 < p_size:
-                end_index = p_size - 1
-                last = p[end_index]
+            context = p.lexer.parse_context
+            symbols = p.slice
+            if 1 < len(symbols):
+                last = symbols[-1]
                 # Any other element must end where the last string ended
                 # This is a workaround for PLY in some cases extending the covered space
-                # until the next encountered element. -> Use last_end_of and last_end_line_number
-                # from lexer for other elements.
-                if isinstance(last, text_class):
+                # until the next encountered element. -> Use last_end_pos from the parse context
+                # for other elements.
+                if isinstance(last.value, text_class):
                     # Only encountering a matched string may change the position
-                    lexer.last_end_pos = p.lexpos(end_index) + len(last)
-                    # The string may contain line breaks
-                    lexer.last_end_line_number = p.linespan(end_index)[1] + last.count("\n")
-
-                position = structure.Position(start_line_number = p.lineno(1),
-                                              end_line_number = lexer.last_end_line_number,
-                                              start_pos = p.lexpos(1),
-                                              end_pos = lexer.last_end_pos,
-                                              parse_index = lexer.parse_index)
+                    context.last_end_pos = last.lexpos + len(last.value)
+                    # Found from last_end_pos when needed
+                    context.last_end_line_number = None
+                # The parse does not track positions, so set the start of the symbol as PLY does
+                # when tracking: where its first element starts
+                start_pos = symbols[0].lexpos = symbols[1].lexpos
+                # Line numbers are found from the positions when needed
+                position = structure.Position(None,
+                                              context.last_end_line_number,
+                                              start_pos,
+                                              context.last_end_pos,
+                                              parse_index = context.parse_index,
+                                              line_offsets = context.line_offsets)
             else:
+                # Empty symbol starts where the lexer is
+                symbols[0].lexpos = p.lexer.lexpos
                 position = None
             # The elements will still need to be sorted to the order in which they were encountered,
             # in order to assign comments to the right node
-            lexer.parse_index += 1
+            context.parse_index += 1
 
-            p[0] = convert_fn(position, *p[1:])
+            symbols[0].value = convert_fn(position, *[symbol.value for symbol in symbols[1:]])
 
         fn.__doc__ = expression
         fn.__name__ = str(function_name) # str for Python 2
@@ -228,6 +235,14 @@ def declare_grammar():
 
 declare_grammar()
 
+class ParseContext(object):
+    "State of one parse, so that any number of strings can be parsed at the same time"
+    def __init__(self, string):
+        self.line_offsets = util.line_offsets(string)
+        self.last_end_pos = 0
+        self.last_end_line_number = 0
+        self.parse_index = 0
+
 def p_error(p):
     if p:
         raise ParserError(p.value, p.lineno, p.lexer.lexdata, p.lexpos)
@@ -236,71 +251,67 @@ def p_error(p):
         # does not give the input string.
         raise ParserError("End of file", 0, "", 0)
 
-yacc.yacc(debug = False,
-          picklefile = os.path.join(os.path.dirname(os.path.realpath(__file__)), "parsetab.pickle"))
+# The parser keeps the state of a parse in itself, so each parse uses a copy of this
+master_parser = yacc.yacc(debug = False,
+                          picklefile = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                    "parsetab.pickle"))
 
 ######
 
+# Anything but white space before a comment on its line makes it an end-of-line comment
+NON_SPACE_REGEX = re.compile(r"[^\t \n]")
+
 def specification_from_string(string, options):
     def comments(comment_tokens, empty_line_numbers, last_line_number):
-        def is_at_end_of_line(token, previous_eol_pos):
-            # max, since if at beginning of doc, previous_eol_pos is -1, and the substring would
-            # be empty, and not the actual substring from start of doc until the token
-            return not not re.search(r"[^\t \n]", string[max(previous_eol_pos, 0):token.lexpos])
+        "Return Comments from the comment tokens, which are in the order of the string"
+        line_offsets = cf_lexer.parse_context.line_offsets
         def position(token):
             return structure.Position(start_line_number = token.lineno,
                                       end_line_number = token.lineno,
                                       start_pos = token.lexpos,
                                       end_pos = token.lexpos + len(token.value))
-
-        class State(object):
-            "Contains state of comment parsing"
-            def __init__(self):
-                self.comments = []
-                self.current_comment = []
-            def add_comment(self, comment):
-                if self.current_comment:
-                    if not self.current_comment.type:
-                        if (self.current_comment.position.end_line_number + 1 in empty_line_numbers
-                              or self.current_comment.position.end_line_number == last_line_number):
-                            # This comment is not related to a node (if it is found in a List of
-                            # some kind)
-                            self.current_comment.type = "standalone"
-                        else:
-                            # This comment probably describes the next Node
-                            self.current_comment.type = "next-node"
-                    self.comments.insert(0, self.current_comment)
-                self.current_comment = comment
-            def commit_comment(self):
-                self.add_comment(None)
-            def is_part_of_current_comment(self, line_number):
-                return(self.current_comment and
-                       self.current_comment.position.start_line_number - 1 == line_number)
-
-        state = State()
-
-        for token in reversed(comment_tokens):
-            previous_eol_pos = util.previous_end_of_line_pos(string, token.lexpos)
+        def set_type(comment):
+            if (comment.position.end_line_number + 1 in empty_line_numbers
+                  or comment.position.end_line_number == last_line_number):
+                # This comment is not related to a node (if it is found in a List of some kind)
+                comment.type = "standalone"
+            else:
+                # This comment probably describes the next Node
+                comment.type = "next-node"
+
+        comments = []
+        # Comment that the comment on the next line is part of, if it is not at the end of a line
+        current_comment = None
+        for token in comment_tokens:
+            line_start_pos = line_offsets[token.lineno - 1]
             # The original indentation is used to figure out whether standalone comments belong to
             # promise type list or class promise list
-            original_indentation = token.lexpos - previous_eol_pos - 1
-            if is_at_end_of_line(token, previous_eol_pos):
-                state.add_comment(structure.Comment(position(token), token.value,
-                                                    original_indentation,
-                                                    type = "end-of-line"))
-                state.commit_comment() # Don't add lines to end-of-line comment
-            elif state.is_part_of_current_comment(token.lineno):
-                state.current_comment.prepend_line(position(token), token.value)
+            original_indentation = token.lexpos - line_start_pos
+            if NON_SPACE_REGEX.search(string, line_start_pos, token.lexpos):
+                if current_comment:
+                    set_type(current_comment)
+                    current_comment = None
+                comments.append(structure.Comment(position(token), token.value,
+                                                  original_indentation, type = "end-of-line"))
+            elif (current_comment
+                    and current_comment.position.end_line_number + 1 == token.lineno):
+                current_comment.append_line(position(token), token.value)
+                # A comment has the indentation of its last line
+                current_comment.original_indentation = original_indentation
             else:
-                state.add_comment(structure.Comment(position(token), token.value,
-                                                    original_indentation))
-        state.commit_comment()
-        return state.comments
+                if current_comment:
+                    set_type(current_comment)
+                current_comment = structure.Comment(position(token), token.value,
+                                                    original_indentation)
+                comments.append(current_comment)
+        if current_comment:
+            set_type(current_comment)
+        return comments
 
     def line_numbers_of_empty_lines(string):
-        return [index + 1
-                for index, line in enumerate(string.split("\n"))
-                if re.match(r"^[ \t\r]*$", line)]
+        return set(index + 1
+                   for index, line in enumerate(string.split("\n"))
+                   if re.match(r"^[ \t\r]*$", line))
 
     def set_empty_lines(nodes, empty_line_numbers):
         nodes = filter(lambda node: node.consumes_preceding_empty_line, nodes) # github #6
@@ -321,13 +332,12 @@ def specification_from_string(string, options):
             if node:
                 node.preceded_by_empty_line = True
 
-    cf_lexer = lexer.lexer()
-    lexer.last_end_pos = 0
-    lexer.last_end_line_number = 0
-    lexer.parse_index = 0
+    cf_lexer = lexer.lexer_for(options)
+    cf_lexer.parse_context = ParseContext(string)
     cf_lexer.input(string)
 
-    specification = yacc.parse(string, lexer = cf_lexer, tracking = True)
+    # Positions are set by the grammar functions, so PLY does not need to track them
+    specification = copy.copy(master_parser).parse(string, lexer = cf_lexer)
     nodes = specification.descendants()
     empty_line_numbers = line_numbers_of_empty_lines(string)
     comments = comments(cf_lexer.comments, empty_line_numbers, cf_lexer.lineno)
@@ -336,5 +346,8 @@ def specification_from_string(string, options):
     set_empty_lines(nodes, empty_line_numbers)
     for node in nodes:
         node.after_parse(options)
+    # Children before parents, since width of a node is calculated from widths of its children
+    for node in reversed(nodes):
+        node.set_widths(options)
 
     return specification
@@ -0,0 +1,122 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from . import beautifier
+from . import blocks
+from .util import ParserError
+
+# A document is split into regions as in blocks.py, and each region is parsed on its own. A region
+# has one or more top level items (bundles, bodies and standalone comments), except that the last
+# region may have none. An edit reparses just the regions it touches, and the regions after them
+# if the edited regions no longer end where they did.
+
+class Region(object):
+    "Lines from start to end (offsets in the document), and their parsed items"
+    def __init__(self, start, end, items):
+        self.start = start
+        self.end = end
+        self.items = items
+        self.item_strings = None
+
+class Session(object):
+    """
+    Beautifies a document that is being edited. An edit reparses and re-renders only the top level
+    items (bundles, bodies and standalone comments) that it touches, and to_string gives the same
+    string as beautifier.beautified_string of the edited document.
+    """
+    def __init__(self, string, options = None):
+        "Raises ParserError if fails to parse"
+        self.options = options or beautifier.Options()
+        self.layout_options = None
+        self._parse(string)
+
+    def _parse(self, string):
+        self.string = string
+        self.regions = None
+        options = beautifier.layout_options(string, self.options)
+        # Keep the options if the line endings did not change, so that the items can be compared
+        if (self.layout_options is None
+              or options.line_endings != self.layout_options.line_endings):
+            self.layout_options = options
+        self.regions = [Region(start, end, specification.items) for start, end, specification
+                        in blocks.parsed_regions(string, self.layout_options)]
+
+    def _parsed_regions(self, string, start, offsets):
+        """
+        Return the Regions of string at offsets, which are relative to offset start.
+        Raises ParserError if fails to parse.
+        """
+        start_line_number = string.count("\n", 0, start) + 1
+        result = []
+        for region_start, region_end in offsets:
+            region_start += start
+            region_end += start
+            specification = blocks.region_specification(string, self.layout_options,
+                                                        region_start, region_end,
+                                                        start_line_number)
+            result.append(Region(region_start, region_end, specification.items))
+            start_line_number += string.count("\n", region_start, region_end)
+        return result
+
+    def edit(self, start, end, string):
+        """
+        Replace the text between offsets start and end with string. Raises ParserError if the
+        document fails to parse, after which the next edit parses the whole document.
+        """
+        new_string = self.string[:start] + string + self.string[end:]
+        if (self.regions is None
+              or beautifier.line_endings(new_string, self.options.line_endings)
+                     != self.layout_options.line_endings):
+            self._parse(new_string)
+            return
+        # Regions that the edit touches, including the ones it is at the edge of
+        first_index = 0
+        while first_index < len(self.regions) - 1 and self.regions[first_index].end < start:
+            first_index += 1
+        last_index = first_index
+        while last_index < len(self.regions) - 1 and self.regions[last_index + 1].start <= end:
+            last_index += 1
+
+        change = len(string) - (end - start)
+        while True:
+            region_start = self.regions[first_index].start
+            region_end = self.regions[last_index].end + change
+            is_at_end = last_index == len(self.regions) - 1
+            try:
+                offsets = blocks.regions(new_string[region_start:region_end], self.layout_options,
+                                         is_followed_by_block = not is_at_end)
+                if is_at_end:
+                    new_regions = self._parsed_regions(new_string, region_start, offsets)
+                    break
+                # The edited regions end where the next region starts, if the rest is empty
+                if offsets[-1][0] == region_end - region_start:
+                    new_regions = self._parsed_regions(new_string, region_start, offsets[:-1])
+                    break
+            except ParserError:
+                # The edit may have changed where the items end (e.g., removed a closing brace)
+                self._parse(new_string)
+                return
+            last_index += 1
+
+        for region in self.regions[last_index + 1:]:
+            region.start += change
+            region.end += change
+        self.regions[first_index:last_index + 1] = new_regions
+        self.string = new_string
+
+    def items(self):
+        return [item for region in self.regions for item in region.items]
+
+    def item_strings(self, regions = None):
+        "Return the beautified strings of the items in regions, all regions by default"
+        item_options = self.layout_options.child(respects_preceding_empty_line = None)
+        item_strings = []
+        for region in (self.regions if regions is None else regions):
+            if region.item_strings is None:
+                region.item_strings = [item.to_string(item_options) for item in region.items]
+            item_strings.extend(region.item_strings)
+        return item_strings
+
+    def to_string(self):
+        item_strings = self.item_strings()
+        line_endings = self.layout_options.line_endings
+        return (line_endings * 2).join(item_strings) + line_endings if item_strings else ""
@@ -2,8 +2,11 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 from .color import Color
-from functools import reduce
+from . import document
+from .version_abstraction import write_stream
+from collections import namedtuple
 from itertools import chain
+import bisect
 import copy
 import re
 import sys
@@ -21,12 +24,38 @@ def merged_dicts(*dicts):
     return dict(chain(*map(lambda d: d.items(), dicts)))
 
 class Position(object):
-    def __init__(self, start_line_number, end_line_number, start_pos, end_pos, parse_index = None):
-        self.start_line_number = start_line_number
-        self.end_line_number = end_line_number
+    __slots__ = ("_start_line_number", "_end_line_number", "start_pos", "end_pos", "parse_index",
+                 "line_offsets")
+    def __init__(self, start_line_number, end_line_number, start_pos, end_pos, parse_index = None,
+                 line_offsets = None):
+        """
+        The line numbers may be None if line_offsets (util.line_offsets of the parsed string) is
+        given, and then they are found from start_pos and end_pos when needed
+        """
+        self._start_line_number = start_line_number
+        self._end_line_number = end_line_number
         self.start_pos = start_pos
         self.end_pos = end_pos
         self.parse_index = parse_index
+        self.line_offsets = line_offsets
+    def _line_number(self, pos):
+        return bisect.bisect_right(self.line_offsets, pos)
+    @property
+    def start_line_number(self):
+        if self._start_line_number is None:
+            self._start_line_number = self._line_number(self.start_pos)
+        return self._start_line_number
+    @start_line_number.setter
+    def start_line_number(self, line_number):
+        self._start_line_number = line_number
+    @property
+    def end_line_number(self):
+        if self._end_line_number is None:
+            self._end_line_number = self._line_number(self.end_pos)
+        return self._end_line_number
+    @end_line_number.setter
+    def end_line_number(self, line_number):
+        self._end_line_number = line_number
     def covers(self, line_number):
         return self.start_line_number <= line_number <= self.end_line_number
     def __repr__(self):
@@ -41,7 +70,9 @@ def isinstance_fn(klass):
     fn.__name__ = str("isinstance_" + klass.__name__) # str for Python 2
     return fn
 
+# Lines are never modified after creation, so they may be shared by templates and cached lines
 class Line(object):
+    __slots__ = ("string", "indent", "end_comments")
     def __init__(self, string, indent = None, end_comments = []):
         self.string = string
         self.indent = indent
@@ -55,40 +86,84 @@ class Line(object):
                     indent = self.indent if self.indent != None else line.indent,
                     end_comments = self.end_comments + line.end_comments)
     def __eq__(self, line):
-        return isinstance(line, self.__class__) and self.__dict__ == line.__dict__
+        return (isinstance(line, self.__class__)
+                and self.string == line.string
+                and self.indent == line.indent
+                and self.end_comments == line.end_comments)
     def __ne__(self, line):
         return not self.__eq__(line)
     def __repr__(self):
         return 'Line("%s", %s)' % (self.string, str(self.indent))
 
-class Options(object):
+class Options(namedtuple("Options", ["settings",
+                                     "indent",
+                                     "ancestor_indent",
+                                     "may_line_break_constraint",
+                                     "respects_preceding_empty_line",
+                                     "allow_braceless_argument_list"])):
+    """
+    Layout context of a node. Immutable and hashable, so it is cheap to derive for children and
+    is used as the key for caching lines.
+    settings: beautifier.Options, the static settings that are the same for the whole document
+    indent: depth of lines after the first one, relative to ancestor_indent
+    may_line_break_constraint: whether there may be a line break in constraint (type => value)
+                               before value
+    respects_preceding_empty_line: if True or False, overrides Node
+    allow_braceless_argument_list: If True, () in empty argument list may be removed
+                                   If False, function call without () is a syntax error
+    """
+    __slots__ = ()
     DEFAULT_RESPECTS_PRECEDING_EMPTY_LINE = None
-    def __init__(self, beautifier_options):
-        # Copy properties from beautifier_options
-        for attr in filter(lambda attr: not attr.startswith("__"), dir(beautifier_options)):
-            value = getattr(beautifier_options, attr)
-            if not hasattr(value, '__call__'):
-                setattr(self, attr, value)
-        self.indent = 0
-        self.ancestor_indent = 0
-        # Whether there may be a line break in constraint (type => value) before value
-        self.may_line_break_constraint = True
-        # if True or False, overrides Node
-        self.respects_preceding_empty_line = Options.DEFAULT_RESPECTS_PRECEDING_EMPTY_LINE
-        # If True, () in empty argument list may be removed
-        # If False, function call without () is a syntax error
-        self.allow_braceless_argument_list = True
+    def __new__(cls, settings,
+                indent = 0,
+                ancestor_indent = 0,
+                may_line_break_constraint = True,
+                respects_preceding_empty_line = DEFAULT_RESPECTS_PRECEDING_EMPTY_LINE,
+                allow_braceless_argument_list = True):
+        return super(Options, cls).__new__(cls, settings, indent, ancestor_indent,
+                                           may_line_break_constraint,
+                                           respects_preceding_empty_line,
+                                           allow_braceless_argument_list)
+    @property
+    def page_width(self):
+        return self.settings.page_width
+    @property
+    def line_endings(self):
+        return self.settings.line_endings
+    @property
+    def removes_empty_promise_types(self):
+        return self.settings.removes_empty_promise_types
+    @property
+    def sorts_promise_types_to_evaluation_order(self):
+        return self.settings.sorts_promise_types_to_evaluation_order
+    @property
+    def layout_engine(self):
+        return self.settings.layout_engine
+    @property
+    def lexer(self):
+        return self.settings.lexer
     def depth(self):
         return self.indent + self.ancestor_indent
     def tabs(self, count):
         return " " * (TAB_SIZE * count)
     def available_width(self):
         return self.page_width - self.depth()
-    def indent_lines(self, lines):
-        if lines:
-            depth = self.indent
-            for line in lines[1:]:
-                line.indent = (line.indent or 0) + depth
+    def document_key(self):
+        "Return the options that affect the document of a node, for caching the documents"
+        return (self.may_line_break_constraint,
+                self.respects_preceding_empty_line,
+                self.allow_braceless_argument_list)
+    def indented_lines(self, lines):
+        "Return lines with all but the first line indented. Does not modify the given lines."
+        if not lines:
+            return lines
+        depth = self.indent
+        def indented_line(line):
+            indent = (line.indent or 0) + depth
+            if indent == line.indent:
+                return line # Lines are immutable, so can be shared
+            return Line(line.string, indent = indent, end_comments = line.end_comments)
+        return [lines[0]] + list(map(indented_line, lines[1:]))
     def child(self, *line_arrays_and_char_counts, **kwargs):
         # Cannot have explicit keyword args after splat args
         respects_preceding_empty_line = kwargs.get("respects_preceding_empty_line",
@@ -96,28 +171,94 @@ class Options(object):
 
         def added_depth():
             def depth(lines_or_char_count):
-                if isinstance(lines_or_char_count, list):
+                if isinstance(lines_or_char_count, (list, tuple)):
                     return lines_or_char_count[-1].length()
                 else:
                     return lines_or_char_count
             return sum(map(depth, line_arrays_and_char_counts))
-        child = copy.copy(self)
-        child.ancestor_indent += self.indent
-        child.indent = added_depth()
-        # Don't inherit the respect for empty line; it is used by list for inlining
-        child.respects_preceding_empty_line = respects_preceding_empty_line
-        return child
+        return self._make((self.settings,
+                           added_depth(),
+                           self.ancestor_indent + self.indent,
+                           self.may_line_break_constraint,
+                           # Don't inherit the respect for empty line; it is used by list for
+                           # inlining
+                           respects_preceding_empty_line,
+                           self.allow_braceless_argument_list))
+
+class LineBuffer(object):
+    """
+    Joins line arrays as joined_lines does, in time linear to the length of the lines. The last
+    line is kept as a list of strings until it is complete, so joining to it does not copy the
+    line (or its end comments).
+    """
+    def __init__(self):
+        self.complete_lines = []
+        # The last line, None if there are no lines
+        self.strings = None
+        self.indent = None
+        self.end_comments = None
+        self.string_length = 0
+    def append(self, lines):
+        "Join lines to the last line. Return the number of lines completed by this."
+        if not lines:
+            return 0
+        first_line = lines[0]
+        if self.strings == None:
+            self._start_last_line(first_line)
+        else:
+            self.strings.append(first_line.string)
+            self.string_length += len(first_line.string)
+            if self.indent == None:
+                self.indent = first_line.indent
+            self.end_comments.extend(first_line.end_comments)
+        if len(lines) == 1:
+            return 0
+        self.complete_lines.append(self._last_line())
+        self.complete_lines.extend(lines[1:-1])
+        self._start_last_line(lines[-1])
+        return len(lines) - 1
+    def _start_last_line(self, line):
+        self.strings = [line.string]
+        self.string_length = len(line.string)
+        self.indent = line.indent
+        self.end_comments = list(line.end_comments)
+    def _last_line(self):
+        return Line("".join(self.strings), indent = self.indent, end_comments = self.end_comments)
+    def last_line_length(self):
+        "Same as Line.length of the last line"
+        return self.string_length + (self.indent or 0)
+    def max_line_length(self, last_line_count):
+        "Return the max length of the last last_line_count lines"
+        lengths = line_lengths(self.complete_lines[len(self.complete_lines) + 1 - last_line_count:])
+        return max(chain([self.last_line_length()], lengths))
+    def lines(self):
+        if self.strings == None:
+            return []
+        return self.complete_lines + [self._last_line()]
 
 def joined_lines(*line_arrays):
-    joined_lines = []
+    line_buffer = LineBuffer()
     for lines in line_arrays:
+        line_buffer.append(lines)
+    return line_buffer.lines()
+
+def joined_lines_within(width_budget, *line_arrays_and_fns):
+    """
+    Same as joined_lines, but a line array may also be given as a function that returns the line
+    array. The function is called only if the lines joined so far fit. Returns None as soon as some
+    line is longer than width_budget, which is ignored if None.
+    """
+    line_buffer = LineBuffer()
+    for lines in line_arrays_and_fns:
+        if hasattr(lines, "__call__"):
+            lines = lines()
         if lines:
-            if not joined_lines:
-                joined_lines.extend(lines)
-            else:
-                joined_lines[-1] = joined_lines[-1].joined(lines[0])
-                joined_lines.extend(lines[1:])
-    return joined_lines
+            # The last line of the buffer changes, and appended lines follow it
+            changed_line_count = line_buffer.append(lines) + 1
+            if (width_budget != None
+                and width_budget < line_buffer.max_line_length(changed_line_count)):
+                return None
+    return line_buffer.lines()
 
 def line_lengths(lines):
     return map(lambda line: line.length(), lines)
@@ -152,14 +293,14 @@ def find_index(predicate, items, start_index = None, not_found = None, reverse =
     if reverse:
         if start_index == None:
             start_index = len(items)
-        index_item_pairs = reversed(list(enumerate(items))[:start_index + 1])
+        indexes = range(min(start_index, len(items) - 1), -1, -1)
     else:
         if start_index == None:
             start_index = 0
-        index_item_pairs = list(enumerate(items))[start_index:]
+        indexes = range(start_index, len(items))
 
-    for index, item in index_item_pairs:
-        if predicate(item):
+    for index in indexes:
+        if predicate(items[index]):
             return index
     return not_found
 
@@ -174,20 +315,35 @@ def add_comments_to_items(items, comments_by_item, parents):
             log_comment(Color.magenta("Add comments to "), item, Color.blue("Comments"), comments)
             item.add_comments(comments, parents)
 
-def is_end_of_line_comment_for(node, comment, nodes):
-    def last_for_line(line_number):
-        i = len(nodes) - 1
-        while 0 <= i:
-            node_at_i = nodes[i]
-            pos_at_i = node_at_i.position
-            if pos_at_i.start_line_number <= line_number <= pos_at_i.end_line_number:
-                return node_at_i
-            if node_at_i == node:
-                return None
-            i -= 1
-        return None
-    return (comment.position.end_line_number <= node.position.end_line_number and
-            last_for_line(comment.position.start_line_number) == node)
+def is_sorted(values):
+    return all(value <= next_value for value, next_value in zip(values, values[1:]))
+
+class NodeLines(object):
+    "Line spans of nodes, to find the last node on a line"
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.start_line_numbers = [node.position.start_line_number for node in nodes]
+        self.end_line_numbers = [node.position.end_line_number for node in nodes]
+        # Sibling nodes are in the order of the document, and do not overlap, except maybe for the
+        # lines on which one ends and the next starts. Otherwise the nodes are scanned.
+        self.is_sorted = is_sorted(self.start_line_numbers) and is_sorted(self.end_line_numbers)
+    def covers(self, index, line_number):
+        return self.start_line_numbers[index] <= line_number <= self.end_line_numbers[index]
+    def is_last_on_line(self, index, line_number):
+        "Return True if the node at index is on the line, and no node after it is"
+        if not self.covers(index, line_number):
+            return False
+        if self.is_sorted:
+            # The last node that starts on or before the line ends before the line, or is this
+            last_index = bisect.bisect_right(self.start_line_numbers, line_number) - 1
+            return last_index <= index or self.end_line_numbers[last_index] < line_number
+        return not any(self.covers(later_index, line_number)
+                       for later_index in range(index + 1, len(self.nodes)))
+
+def is_end_of_line_comment_for(index, comment, node_lines):
+    "Return True if comment is at the end of the line of the node at index in NodeLines node_lines"
+    return (comment.position.end_line_number <= node_lines.end_line_numbers[index] and
+            node_lines.is_last_on_line(index, comment.position.start_line_number))
 
 def items_and_comments_by_item(items, comments, standalone_policy,
                                is_standalone_comment_for_node_fn = None):
@@ -207,6 +363,7 @@ def items_and_comments_by_item(items, comments, standalone_policy,
     new_items = []
     comments_by_item = {}
     item_index = 0
+    node_lines = NodeLines(items)
     for comment in comments:
         def is_standalone_comment_before(node):
             return (comment.is_standalone()
@@ -227,7 +384,7 @@ def items_and_comments_by_item(items, comments, standalone_policy,
                                items[item_index + 1].position.start_line_number))
 
             if(comment.position.end_line_number < item.position.end_line_number
-               or is_end_of_line_comment_for(item, comment, items)
+               or is_end_of_line_comment_for(item_index, comment, node_lines)
                # This behavior is indented to allow non-removal of promise types that are otherwise
                # empty but have comments
                or (standalone_policy == "insert"
@@ -251,29 +408,70 @@ def items_and_comments_by_item(items, comments, standalone_policy,
     new_items.extend(items[item_index:])
     return (new_items, comments_by_item)
 
-def first_that_fits(options, lines_fns):
+def document_from_lines(lines):
+    "Return document.Document that renders as the given lines"
+    documents = []
+    for index, line in enumerate(lines or []):
+        if index:
+            documents.append(document.LineBreak())
+        documents.append(document.Text(line.string, line.indent))
+        documents.extend(map(lambda end_comment: document.EndComment(end_comment.string),
+                             line.end_comments))
+    return document.concat(*documents)
+
+def first_that_fits(options, lines_fns, min_widths = None):
     """
     Returns the first set of lines returned by the "make lines" function that fits into the available
     width"
-    lines_fn signature: (options) -> [Line, ...]
+    lines_fn signature: (options, width_budget) -> [Line, ...] or None
+                        lines_fn may return None (e.g., by using joined_lines_within) as soon as
+                        its lines are known to be longer than width_budget. width_budget is None
+                        for the last lines_fn, which must always return the lines.
+    min_widths: lower bounds for the width of the first line of each lines_fn. lines_fn is not
+                called if its lines cannot fit.
     """
     lines = []
-    for lines_fn in lines_fns:
-        lines = lines_fn(options)
-        if max_line_length(lines) <= options.available_width():
+    available_width = options.available_width()
+    last_index = len(lines_fns) - 1
+    for index, lines_fn in enumerate(lines_fns):
+        if index < last_index:
+            if min_widths and available_width < min_widths[index]:
+                continue
+            width_budget = available_width
+        else:
+            width_budget = None
+        lines = lines_fn(options, width_budget)
+        if lines != None and max_line_length(lines) <= available_width:
             break
     return lines
 
 # ----- Node Classes ------------------------------------------------------------------------------
 
 class Node(object):
+    __slots__ = ("position",
+                 "text",
+                 "preceded_by_empty_line",
+                 "respects_preceding_empty_line",
+                 "comments",
+                 "priority_of_giving_parent_comments",
+                 "allows_end_of_line_comments",
+                 "consumes_preceding_empty_line",
+                 "rendered_options",
+                 "rendered_lines",
+                 "lines_by_options",
+                 "documents_by_key",
+                 "flat_width",
+                 "has_single_layout",
+                 "min_first_line_width")
+    # Names of the attributes that are child nodes (or None)
+    CHILD_NAMES = ()
     def __init__(self, position, text = None):
-        self.child_by_name = {}
         self.position = position
         self.text = text
         self.preceded_by_empty_line = False
         self.respects_preceding_empty_line = False
-        self.comments = []
+        # Nodes share the empty tuple until they are given comments
+        self.comments = ()
         # Controls whether gives comments to parent. Also controls with comment gets to be end of
         # line comment if many end of line comments.
         #   None: keeps the comment itself (or gives to child)
@@ -285,14 +483,32 @@ class Node(object):
         self.allows_end_of_line_comments = True
         # If False, the empty line will be offered to the next node
         self.consumes_preceding_empty_line = True
+        # Lines are cached by Options. Layout functions render the same child many times when
+        # trying out alternatives, and without this, the time would grow exponentially by depth.
+        # Most nodes are rendered with just one Options, which are kept in rendered_options and
+        # rendered_lines. Lines for other Options are in lines_by_options, created when needed.
+        self.rendered_options = None
+        self.rendered_lines = None
+        self.lines_by_options = None
+        # Documents by Options.document_key(), for the document layout engine
+        self.documents_by_key = None
+        # Widths are set by set_widths after parsing, and allow rejecting layouts without rendering
+        # them. flat_width is the width of the node on a single line, or None if it cannot be on a
+        # single line (e.g., has comments or multi-line strings). has_single_layout is True if the
+        # node is rendered as flat_width wide in every layout. min_first_line_width is a lower
+        # bound for the width of the first line in any layout.
+        self.flat_width = None
+        self.has_single_layout = False
+        self.min_first_line_width = 0
     def after_parse(self, options):
         pass
+    def set_widths(self, options):
+        "Set the width attributes. Called after parsing, for children before parents."
+        pass
+    def may_be_single_line(self):
+        return not self.comments and not self.preceded_by_empty_line
     def _node_names(self):
         return filter(lambda x: x.startswith("p_"), dir(self))
-    def __getitem__(self, name):
-        return self.child_by_name[name]
-    def __setitem__(self, name, value):
-        self.child_by_name[name] = value
     # Return all nodes from the node tree as a flat list (depth-first order), so each
     # node will be in the order they appear in the cf file
     def descendants(self):
@@ -301,7 +517,7 @@ class Node(object):
             descendants.extend([child] + child.descendants())
         return descendants
     def children(self):
-        return sorted(filter(None, self.child_by_name.values()),
+        return sorted(filter(None, map(lambda name: getattr(self, name), self.CHILD_NAMES)),
                       key = lambda node: node.position.parse_index)
     def give_comment_for_adoption(self, comments, parents):
         parents[-1].adopt_comments(comments, self.priority_of_giving_parent_comments, parents[:-1])
@@ -318,6 +534,8 @@ class Node(object):
                 for comment in comments:
                     if comment.is_end_of_line:
                         comment.type = "next-node"
+            if not self.comments:
+                self.comments = []
             self.comments.extend(comments)
     # All the given comments must be assignable and be assigned, otherwise an error
     def add_comments(self, comments, parents):
@@ -355,11 +573,26 @@ class Node(object):
         tail_comment = tail_comment or self.tail_comment()
         return [comment for comment in self.comments if comment != tail_comment]
     def lines(self, options):
-        def merged_comment(comments):
-            merged_comment = copy.deepcopy(comments[0])
-            for comment in comments[1:]:
-                merged_comment.append_comment(comment)
-            return merged_comment
+        """
+        Return the lines as an immutable tuple, which may be shared with other callers. The lines
+        are cached, so the node must not be modified after rendering has started.
+        """
+        if self.rendered_options == options:
+            return self.rendered_lines
+        if self.lines_by_options is not None:
+            lines = self.lines_by_options.get(options)
+            if lines is not None:
+                return lines
+        lines = tuple(self._uncached_lines(options))
+        if self.rendered_options is None:
+            self.rendered_options = options
+            self.rendered_lines = lines
+        else:
+            if self.lines_by_options is None:
+                self.lines_by_options = {}
+            self.lines_by_options[options] = lines
+        return lines
+    def _uncached_lines(self, options):
         lines = self._preceding_empty_line(options)
         if self.comments: # optimisation, saves 30% of rendering time
             # Indentation assumes that first line of the child is indented by the parent, and any
@@ -379,13 +612,43 @@ class Node(object):
             else:
                 line_comment_lines = []
 
-            lines += (line_comment_lines
-                      + joined_lines(self._lines(options),
-                                     [Line("", end_comments = tail_comment_lines)]))
+            lines.extend(line_comment_lines)
+            lines.extend(joined_lines(self._lines(options),
+                                      [Line("", end_comments = tail_comment_lines)]))
         else:
-            lines += self._lines(options)
-        options.indent_lines(lines)
-        return lines
+            lines.extend(self._lines(options))
+        return options.indented_lines(lines)
+    def document(self, options):
+        """
+        Return document.Document for the document layout engine. Unlike lines, the document does
+        not depend on the position of the node, and is cached by the rest of the options.
+        """
+        document_key = options.document_key()
+        if self.documents_by_key is None:
+            self.documents_by_key = {}
+        node_document = self.documents_by_key.get(document_key)
+        if node_document is None:
+            node_document = self._uncached_document(options)
+            self.documents_by_key[document_key] = node_document
+        return node_document
+    def _uncached_document(self, options):
+        # Same structure as in _uncached_lines
+        documents = []
+        if self._preceding_empty_line(options):
+            documents.extend([document.EMPTY, document.LineBreak()])
+        node_document = self._document(options)
+        if self.comments:
+            comment_options = options.child()
+            tail_comment = self.tail_comment()
+            line_comments = self.line_comments(tail_comment)
+            if line_comments:
+                documents.extend([merged_comment(line_comments).document(comment_options),
+                                  document.LineBreak()])
+            if tail_comment:
+                node_document = document.Concat(node_document,
+                                                document.EndComment(" " + tail_comment.formatted_text()))
+        documents.append(node_document)
+        return document.concat(*documents)
     def _preceding_empty_line(self, options):
         respects_empty_line = (options.respects_preceding_empty_line
                                   if options.respects_preceding_empty_line != None
@@ -401,38 +664,79 @@ class Node(object):
                 return " " * line.indent + string
             return string
         line_endings = options.line_endings or "\n"
+        if options.layout_engine == "document":
+            return line_endings.join(document.render(self.document(options), options.page_width))
         return line_endings.join(map(string_from_line, self.lines(options)))
+    def iter_chunks(self, options):
+        "Yield strings that joined are the same as to_string"
+        yield self.to_string(options)
+    def write_to(self, stream, options):
+        "Write to_string to stream, in chunks"
+        for chunk in self.iter_chunks(options):
+            write_stream(stream, chunk)
     def __repr__(self):
         return self.__class__.__name__
 
+def merged_comment(comments):
+    "Return the comments as one Comment"
+    merged_comment = copy.copy(comments[0])
+    # append_comment modifies the text lines and the position, and the copy must not use the
+    # cached lines of the original
+    merged_comment.text_lines = list(merged_comment.text_lines)
+    merged_comment.position = copy.copy(merged_comment.position)
+    merged_comment.rendered_options = None
+    merged_comment.rendered_lines = None
+    merged_comment.lines_by_options = None
+    merged_comment.documents_by_key = None
+    for comment in comments[1:]:
+        merged_comment.append_comment(comment)
+    return merged_comment
+
 class Block(Node):
+    CHILD_NAMES = ("element", "type", "name", "args", "block_child_list")
+    __slots__ = CHILD_NAMES
     def __init__(self, position, element, type, name, args, block_child_list):
         super(Block, self).__init__(position)
-        self["element"] = element
-        self["type"] = type
-        self["name"] = name
-        self["args"] = args
-        self["block_child_list"] = block_child_list
+        self.element = element
+        self.type = type
+        self.name = name
+        self.args = args
+        self.block_child_list = block_child_list
         self.allows_end_of_line_comments = False
     def _lines(self, options):
         child_options = options.child()
         space = [Line(" ")]
-        lines_until_args = joined_lines(self["element"].lines(child_options),
+        lines_until_args = joined_lines(self.element.lines(child_options),
                                         space,
-                                        self["type"].lines(child_options),
+                                        self.type.lines(child_options),
                                         space,
-                                        self["name"].lines(child_options))
+                                        self.name.lines(child_options))
         return joined_lines(lines_until_args,
-                            self["args"].lines(options.child(lines_until_args)),
-                            self["block_child_list"].lines(child_options))
+                            self.args.lines(options.child(lines_until_args)),
+                            self.block_child_list.lines(child_options))
+    def _document(self, options):
+        child_options = options.child()
+        space = document.Text(" ")
+        until_args = document.Concat(self.element.document(child_options),
+                                     space,
+                                     self.type.document(child_options),
+                                     space,
+                                     self.name.document(child_options))
+        return document.Concat(until_args,
+                               document.Nest(document.last_line_width(until_args),
+                                             self.args.document(child_options)),
+                               self.block_child_list.document(child_options))
 
 class Body(Block):
+    __slots__ = ()
     pass
 
 class Bundle(Block):
+    __slots__ = ()
     pass
 
 class Comment(Node):
+    __slots__ = ("text_lines", "type", "original_indentation", "priority")
     def __init__(self, position, line, original_indentation, type = None):
         """
         type means affinity to other element.
@@ -447,17 +751,17 @@ class Comment(Node):
         return self.type == "end-of-line"
     def is_standalone(self):
         return self.type == "standalone"
-    def prepend_line(self, position, line):
+    def append_line(self, position, line):
         if self.is_end_of_line():
-            raise "End of line comments are one liners"
-        self.text_lines.insert(0, line)
-        self.position.start_line_number = position.start_line_number
-        self.position.start_pos = position.start_pos
+            raise ValueError("End of line comments are one liners")
+        self.text_lines.append(line)
+        self.position.end_line_number = position.end_line_number
+        self.position.end_pos = position.end_pos
     def append_comment(self, comment):
         self.text_lines.extend(comment.text_lines)
         self.position.end_line_number = comment.position.end_line_number
         self.position.end_pos = comment.position.end_pos
-    def _lines(self, options):
+    def formatted_text_lines(self):
         # text without starting #
         def text_for_line(line):
             # No space in #-..., or #=... or ##...
@@ -467,8 +771,14 @@ class Comment(Node):
             else:
                 text, = re.match(r"\#[\t ]?(.*)", line).groups()
                 separator = " "
-            return Line("#%s" % separator + text, 0)
+            return "#%s" % separator + text
         return map(text_for_line, self.text_lines)
+    def formatted_text(self):
+        return "".join(self.formatted_text_lines())
+    def _lines(self, options):
+        return map(lambda text: Line(text, 0), self.formatted_text_lines())
+    def _document(self, options):
+        return document_from_lines(list(self._lines(options)))
     def __repr__(self):
         lines_string = ",".join(map(lambda line:
                                         Color.green(line) if DEBUG_COMMENT_TO_TRACK in line else line,
@@ -476,46 +786,60 @@ class Comment(Node):
         return "p%s (%s) %s" % (str(self.priority), self.type, lines_string)
 
 class PromiseType(Node):
+    CHILD_NAMES = ("name", "class_promise_list")
+    __slots__ = CHILD_NAMES
     def __init__(self, position, name, class_promise_list):
         super(PromiseType, self).__init__(position)
-        self["name"] = name
-        self["class_promise_list"] = class_promise_list
-    def name(self):
-        return self["name"].name
+        self.name = name
+        self.class_promise_list = class_promise_list
     def len(self):
-        return self["class_promise_list"].len()
+        return self.class_promise_list.len()
     def _lines(self, options):
         # Avoid double line break when no promises
-        if 0 < self["class_promise_list"].len():
+        if 0 < self.class_promise_list.len():
             join_by = [Line("")] # line break
         else:
             join_by = []
         child_options = options.child()
-        return joined_lines(self["name"].lines(child_options),
-                            join_by + self["class_promise_list"].lines(child_options))
+        return joined_lines(self.name.lines(child_options),
+                            join_by + list(self.class_promise_list.lines(child_options)))
+    def _document(self, options):
+        child_options = options.child()
+        documents = [self.name.document(child_options)]
+        # Avoid double line break when no promises
+        if 0 < self.class_promise_list.len():
+            documents.append(document.LineBreak())
+        documents.append(self.class_promise_list.document(child_options))
+        return document.Concat(*documents)
 
 class Class(Node):
+    CHILD_NAMES = ("expression",)
+    __slots__ = CHILD_NAMES
     def __init__(self, position, expression):
         super(Class, self).__init__(position)
         self.respects_preceding_empty_line = True
-        self["expression"] = expression
+        self.expression = expression
     def _lines(self, options):
-        return self["expression"].lines(options.child())
+        return self.expression.lines(options.child())
+    def _document(self, options):
+        return self.expression.document(options.child())
 
 class Promise(Node):
+    CHILD_NAMES = ("promiser", "promisee", "maybe_comma", "constraints", "semicolon")
+    __slots__ = CHILD_NAMES
     def __init__(self, position, promiser, arrow, promisee, maybe_comma, constraints, semicolon):
         super(Promise, self).__init__(position)
-        self["promiser"] = promiser
-        self["promisee"] = promisee
-        self["maybe_comma"] = maybe_comma # This is never output
-        self["constraints"] = constraints
-        self["semicolon"] = semicolon
+        self.promiser = promiser
+        self.promisee = promisee
+        self.maybe_comma = maybe_comma # This is never output
+        self.constraints = constraints
+        self.semicolon = semicolon
         self.respects_preceding_empty_line = True
     def _lines(self, options):
         promisee_lines = []
         no_indent_options = options.child()
 
-        promiser_lines = self["promiser"].lines(no_indent_options)
+        promiser_lines = self.promiser.lines(no_indent_options)
 
         # Options are:
         #   promiser -> promisee
@@ -524,11 +848,14 @@ class Promise(Node):
         #   promiser_long
         #     -> promisee
 
-        if self["promisee"]:
-            promisee_lines = self["promisee"].lines(no_indent_options)
-            def inline_promisee(options):
-                return joined_lines(promiser_lines, [Line(" -> ")], promisee_lines)
-            def lined_promisee(options):
+        if self.promisee:
+            promisee_lines = self.promisee.lines(no_indent_options)
+            def inline_promisee(options, width_budget):
+                return joined_lines_within(width_budget,
+                                           promiser_lines,
+                                           [Line(" -> ")],
+                                           promisee_lines)
+            def lined_promisee(options, width_budget):
                 return joined_lines(promiser_lines,
                                     [Line(""), Line("-> ", TAB_SIZE)],
                                     promisee_lines)
@@ -550,37 +877,77 @@ class Promise(Node):
         #     constraint;
         #
 
-        def one_liner_string(options):
-            constraints_options = options.child(promiser_lines, 1)
-            constraints_options.may_line_break_constraint = False
-            return joined_lines(promiser_and_promisee,
-                                [Line(" ")],
-                                self["constraints"].lines(constraints_options))
-        def empty_list_string(options):
-            return joined_lines(promiser_and_promisee, self["constraints"].lines(no_indent_options))
-        def lined_string(options):
+        def one_liner_string(options, width_budget):
+            constraints_options = options.child(promiser_lines, 1)._replace(
+                                      may_line_break_constraint = False)
+            return joined_lines_within(width_budget,
+                                       promiser_and_promisee,
+                                       [Line(" ")],
+                                       lambda: self.constraints.lines(constraints_options))
+        def empty_list_string(options, width_budget = None):
+            return joined_lines(promiser_and_promisee, self.constraints.lines(no_indent_options))
+        def lined_string(options, width_budget = None):
             return joined_lines(promiser_and_promisee,
                                 # Line break, and then indent
                                 [Line(""), Line("", TAB_SIZE)],
-                                self["constraints"].lines(options.child(TAB_SIZE)))
-
-        if (self["constraints"].len() == 1
-            and not self["promisee"]
-            and self["promiser"].position.start_line_number
-                    == self["promiser"].position.end_line_number
-            # If the only constraint has line comments, keep it on its own line; otherwise, the
-            # comments would be indented at the end of promise name
-            and not self["constraints"].item_at(0).line_comments()):
+                                self.constraints.lines(options.child(TAB_SIZE)))
+
+        if self._may_be_one_liner():
             # A single constraint may fit on the same line as the promise.
             # First try to fit on one line (without allowing line break in constraint), and if does
             # not fit, put the constraint on its own line (constraing will first try without line
             # break, then with it). If the promise is over multiple lines, don't make it a one liner.
-            lines_fns = [one_liner_string, lined_string]
-        elif self["constraints"].len() == 0:
-            lines_fns = [empty_list_string]
+            return first_that_fits(options, [one_liner_string, lined_string],
+                                   [self._min_one_liner_width(), 0])
+        elif self.constraints.len() == 0:
+            return empty_list_string(options)
         else:
-            lines_fns = [lined_string]
-        return first_that_fits(options, lines_fns)
+            return lined_string(options)
+    def _document(self, options):
+        # Same layouts as in _lines
+        no_indent_options = options.child()
+        promiser = self.promiser.document(no_indent_options)
+        if self.promisee:
+            promiser_and_promisee = document.Group(
+                document.Concat(promiser,
+                                document.SoftLine(" "),
+                                document.Text("-> ", TAB_SIZE),
+                                self.promisee.document(no_indent_options)))
+        else:
+            promiser_and_promisee = promiser
+        constraints = self.constraints
+        lined = document.Concat(promiser_and_promisee,
+                                document.LineBreak(),
+                                document.Text("", TAB_SIZE),
+                                document.Nest(TAB_SIZE, constraints.document(options.child())))
+        if self._may_be_one_liner():
+            constraints_options = options.child()._replace(may_line_break_constraint = False)
+            one_liner = document.Concat(
+                promiser_and_promisee,
+                document.Text(" "),
+                document.Nest(document.last_line_width(promiser) + 1,
+                              constraints.document(constraints_options)))
+            return document.IfFits([one_liner, lined], [self._min_one_liner_width(), 0])
+        elif constraints.len() == 0:
+            return document.Concat(promiser_and_promisee, constraints.document(no_indent_options))
+        else:
+            return lined
+    def _may_be_one_liner(self):
+        return (self.constraints.len() == 1
+                and not self.promisee
+                and self.promiser.position.start_line_number
+                        == self.promiser.position.end_line_number
+                # If the only constraint has line comments, keep it on its own line; otherwise, the
+                # comments would be indented at the end of promise name
+                and not self.constraints.item_at(0).line_comments())
+    def _min_one_liner_width(self):
+        "Return lower bound for the width of the first line of promise with a single constraint"
+        promiser_width = self.promiser.flat_width
+        constraints = self.constraints
+        if promiser_width == None or constraints.comments:
+            return 0
+        # 1 for the space between promiser and constraint
+        return promiser_width + 1 + constraints.item_at(0).min_inlined_width
 
 # The values of these may contain functions. Function arglist in that case will have braces even
 # if the arglist is empty.
@@ -594,68 +961,130 @@ NON_BUNDLE_OR_BODY_CONSTRAINT_TYPES = ["ifvarclass",
                                        "rlist"]
 
 class Constraint(Node):
+    CHILD_NAMES = ("type", "assign", "value", "maybe_comma")
+    __slots__ = CHILD_NAMES + ("min_inlined_width",)
     def __init__(self, position, type, assign, value, maybe_comma):
         super(Constraint, self).__init__(position)
-        self["type"] = type
-        self["assing"] = assign
-        self["value"] = value
-        self["maybe_comma"] = maybe_comma
-    def _lines(self, options):
-        type_lines = self["type"].lines(options.child())
-
+        self.type = type
+        self.assign = assign
+        self.value = value
+        self.maybe_comma = maybe_comma
+        # Lower bound for the width of the first line when not line broken after =>
+        self.min_inlined_width = 0
+    def set_widths(self, options):
+        type_width = self.type.flat_width
+        value = self.value
+        if self.may_be_single_line() and type_width != None:
+            # 3 for " =>", which is the shortest first line, if line broken after =>
+            self.min_first_line_width = type_width + 3
+            # 4 for " => "
+            self.min_inlined_width = type_width + 4 + value.min_first_line_width
+            if value.flat_width != None:
+                self.flat_width = type_width + 4 + value.flat_width
+    def _value_options_base(self, options):
         # It appears to be more maintainable to list the constraint types that may have a function
         # call, than to list all constraint types that may be a bundle or a body (although
         # cf-promises could be asked for the full body list, which might be used in the future)
-        if self["type"].name in NON_BUNDLE_OR_BODY_CONSTRAINT_TYPES:
+        if self.type.name in NON_BUNDLE_OR_BODY_CONSTRAINT_TYPES:
             # Disable removal of braces from function args, if empty arg list
-            value_options_base = copy.copy(options)
-            value_options_base.allow_braceless_argument_list = False
+            return options._replace(allow_braceless_argument_list = False)
         else:
             # Bundle and body arglist may be without braces
-            value_options_base = options
+            return options
+    def _lines(self, options):
+        type_lines = self.type.lines(options.child())
+        value_options_base = self._value_options_base(options)
 
-        lines_fns = [lambda options:
+        lines_fns = [lambda options, width_budget:
                          # First try to fit all on the same line
-                         joined_lines(type_lines,
-                                      [Line(" => ")],
-                                      # 4 for " => "
-                                      self["value"].lines(value_options_base.child(type_lines, 4)))]
+                         joined_lines_within(width_budget,
+                                             type_lines,
+                                             [Line(" => ")],
+                                             # 4 for " => "
+                                             lambda: self.value.lines(
+                                                         value_options_base.child(type_lines, 4)))]
         if options.may_line_break_constraint:
-            lines_fns.append(lambda options:
+            lines_fns.append(lambda options, width_budget:
                                  # If does not fit, break after =>
                                  joined_lines(type_lines,
                                               [Line(" =>"), Line("", TAB_SIZE)],
-                                              self["value"].lines(value_options_base.child(TAB_SIZE))))
-        return first_that_fits(options, lines_fns)
+                                              self.value.lines(value_options_base.child(TAB_SIZE))))
+        return first_that_fits(options, lines_fns, [self.min_inlined_width, 0])
+    def _document(self, options):
+        type_document = self.type.document(options.child())
+        value_document = self.value.document(self._value_options_base(options).child())
+        alternatives = [document.Concat(type_document,
+                                        document.Text(" => "),
+                                        # 4 for " => "
+                                        document.Nest(document.last_line_width(type_document) + 4,
+                                                      value_document))]
+        if options.may_line_break_constraint:
+            alternatives.append(document.Concat(type_document,
+                                                document.Text(" =>"),
+                                                document.LineBreak(),
+                                                document.Text("", TAB_SIZE),
+                                                document.Nest(TAB_SIZE, value_document)))
+        return document.if_fits(alternatives, [self.min_inlined_width, 0])
 
 # This is inside body { ... }
 class Selection(Constraint):
+    __slots__ = ()
     def __init__(self, *args):
         super(Selection, self).__init__(*args)
         self.respects_preceding_empty_line = True
     def _lines(self, options):
+        return joined_lines(super(Selection, self)._lines(self._selection_options(options)),
+                            [Line(";")])
+    def _document(self, options):
+        return document.Concat(super(Selection, self)._document(self._selection_options(options)),
+                               document.Text(";"))
+    def _selection_options(self, options):
         # Body constraint value may currently not be a bundle or body call, so assume it may be
         # a function call, i.e., disable removal of braces from empty arglist
-        options = copy.deepcopy(options)
-        options.allow_braceless_argument_list = False
-
-        return joined_lines(super(Selection, self)._lines(options), [Line(";")])
+        return options._replace(allow_braceless_argument_list = False)
 
 class Function(Node):
+    CHILD_NAMES = ("name", "args")
+    __slots__ = CHILD_NAMES
     def __init__(self, position, name, args):
         super(Function, self).__init__(position)
-        self["name"] = name
-        self["args"] = args
+        self.name = name
+        self.args = args
+    def set_widths(self, options):
+        name = self.name
+        args = self.args
+        if self.may_be_single_line() and name.has_single_layout:
+            self.min_first_line_width = name.flat_width + args.min_first_line_width
+            if args.flat_width != None:
+                self.flat_width = name.flat_width + args.flat_width
+                self.has_single_layout = args.has_single_layout
     def _lines(self, options):
-        name_lines = self["name"].lines(options.child())
-        return joined_lines(name_lines, self["args"].lines(options.child(name_lines)))
+        name_lines = self.name.lines(options.child())
+        return joined_lines(name_lines, self.args.lines(options.child(name_lines)))
+    def _document(self, options):
+        name_document = self.name.document(options.child())
+        return document.Concat(name_document,
+                               document.Nest(document.last_line_width(name_document),
+                                             self.args.document(options.child())))
 
 class String(Node):
+    __slots__ = ("name",)
     def __init__(self, position, name):
         super(String, self).__init__(position)
         self.name = name
+    def set_widths(self, options):
+        if self.may_be_single_line() and not "\n" in self.name:
+            self.flat_width = self.min_first_line_width = len(self.name)
+            self.has_single_layout = True
+    def lines(self, options):
+        if self.comments or self.preceded_by_empty_line:
+            return super(String, self).lines(options)
+        # Same lines for all options, and cheaper to create than to keep in the cache
+        return (Line(self.name, 0),)
     def _lines(self, options):
         return [Line(self.name, 0)]
+    def _document(self, options):
+        return document.Text(self.name, 0)
     def add_comments(self, comments, parents):
         log_comment(Color.red("Add comments to String"), self, Color.blue("Comments"), comments)
         if self.priority_of_giving_parent_comments:
@@ -668,14 +1097,15 @@ class String(Node):
 # ----- List Classes ------------------------------------------------------------------------------
 
 class ListBase(Node):
+    __slots__ = ("open_brace", "items", "close_brace")
     def __init__(self, position, open_brace, items, trailing_comma, close_brace):
         super(ListBase, self).__init__(position)
         self.priority_of_giving_parent_comments = 1
-        self["open_brace"] = open_brace
+        self.open_brace = open_brace
         self.items = items
-        self["close_brace"] = close_brace
+        self.close_brace = close_brace
     def children(self):
-        return filter(None, [self["open_brace"]] + self.items + [self["close_brace"]])
+        return filter(None, [self.open_brace] + self.items + [self.close_brace])
     def len(self):
         return len(self.items)
     def item_at(self, index):
@@ -683,10 +1113,10 @@ class ListBase(Node):
     def add_comments(self, comments, parents):
         log_comment(Color.red("List"), self, Color.blue("Given comments"), comments)
 
-        if self["close_brace"]:
+        if self.close_brace:
             close_brace_comments, comments = (
                 partition(lambda comment:
-                              self["close_brace"].position.start_pos < comment.position.start_pos,
+                              self.close_brace.position.start_pos < comment.position.start_pos,
                           comments))
         else:
             close_brace_comments = []
@@ -714,8 +1144,8 @@ class ListBase(Node):
                                               self.is_standalone_comment_for_node(node, comment)))
 
         if close_brace_comments:
-            comments_by_item[self["close_brace"]] = close_brace_comments
-            new_items_with_close_brace = new_items + [self["close_brace"]]
+            comments_by_item[self.close_brace] = close_brace_comments
+            new_items_with_close_brace = new_items + [self.close_brace]
         else:
             new_items_with_close_brace = new_items
 
@@ -725,23 +1155,32 @@ class ListBase(Node):
     def is_standalone_comment_for_node(self, item, comment):
         return False
     def _lines(self, options):
-        return first_that_fits(options, map(lambda list_arg:
-                                                lambda options: self._format_items(options, **list_arg),
-                                            self.list_args(options)))
+        list_args = self.list_args(options)
+        return first_that_fits(options,
+                               list(map(lambda list_arg:
+                                            lambda options, width_budget:
+                                                self._format_items(options, width_budget, **list_arg),
+                                        list_args)),
+                               list(map(lambda list_arg: list_arg.get("min_width", 0), list_args)))
+    def _document(self, options):
+        list_args = self.list_args(options)
+        return document.if_fits(list(map(lambda list_arg:
+                                             self._format_items_document(options, **list_arg),
+                                         list_args)),
+                                list(map(lambda list_arg: list_arg.get("min_width", 0), list_args)))
     def _format_items(self, options,
+                      width_budget = None,
                       join_by = None,
                       prefix_by = None,
                       postfix_by = None,
-                      empty = [Line("")],
+                      empty = (Line(""),),
                       start = None,
                       end = None,
                       terminator = "",
                       end_terminator = "",
                       respects_preceding_empty_line_fn = lambda is_first: None, # None means ignored
-                      depth_fn = lambda list, node: 0):
-        join_by, prefix_by, postfix_by, empty, start, end = (
-            map(copy.deepcopy, [join_by, prefix_by, postfix_by, empty, start, end]))
-
+                      depth_fn = lambda list, node: 0,
+                      min_width = 0):
         def child_lines(node, terminator, index):
             # Avoid commas etc at the end of standalone comments
             if isinstance(node, Comment):
@@ -758,32 +1197,118 @@ class ListBase(Node):
             return empty
         else:
             terminators = [terminator] * (len(self.items) - 1) + [end_terminator]
-            # Want to say map(lambda (index, (terminator, node)) but cannot in Python 3
-            child_line_arrays = list(map(lambda idx_and_terminator_node_pair:
-                                             joined_lines(prefix_by,
-                                                          child_lines(idx_and_terminator_node_pair[1][1],
-                                                                      idx_and_terminator_node_pair[1][0],
-                                                                      idx_and_terminator_node_pair[0]),
-                                                          postfix_by),
-                                         enumerate(zip(terminators, self.items))))
-            children_lines = reduce(lambda joined, lines: joined_lines(joined, join_by, lines),
-                                     child_line_arrays[1:],
-                                     child_line_arrays[0])
-            return joined_lines(start, children_lines, end)
-
-LINE_BREAK = [Line(""), Line("")]
+            def child_line_array_fn(node, terminator, index):
+                return lambda: joined_lines(prefix_by,
+                                            child_lines(node, terminator, index),
+                                            postfix_by)
+            # Children are rendered lazily, so that rendering stops when over the width budget
+            line_arrays_and_fns = [start]
+            for index, (terminator, node) in enumerate(zip(terminators, self.items)):
+                if index:
+                    line_arrays_and_fns.append(join_by)
+                line_arrays_and_fns.append(child_line_array_fn(node, terminator, index))
+            line_arrays_and_fns.append(end)
+            return joined_lines_within(width_budget, *line_arrays_and_fns)
+    def _format_items_document(self, options,
+                               join_by = None,
+                               prefix_by = None,
+                               postfix_by = None,
+                               empty = (Line(""),),
+                               start = None,
+                               end = None,
+                               terminator = "",
+                               end_terminator = "",
+                               respects_preceding_empty_line_fn = lambda is_first: None,
+                               depth_fn = lambda list, node: 0,
+                               min_width = 0):
+        "Same as _format_items, but returns document.Document"
+        if not self.items:
+            return document_from_lines(empty)
+        join_by, prefix_by, postfix_by = map(document_from_lines, [join_by, prefix_by, postfix_by])
+        documents = [document_from_lines(start)]
+        last_index = len(self.items) - 1
+        for index, node in enumerate(self.items):
+            if index:
+                documents.append(join_by)
+            # Avoid commas etc at the end of standalone comments
+            if isinstance(node, Comment):
+                node_terminator = ""
+            else:
+                node_terminator = end_terminator if index == last_index else terminator
+            depth = depth_fn(self, node)
+            child_options = options.child(respects_preceding_empty_line =
+                                              respects_preceding_empty_line_fn(index == 0))
+            documents.extend([prefix_by,
+                              document.Text("", depth),
+                              document.Nest(depth, node.document(child_options)),
+                              document.Text(node_terminator),
+                              postfix_by])
+        documents.append(document_from_lines(end))
+        return document.Concat(*documents)
+
+# List args are shared templates, so neither them nor their Lines may be modified
+LINE_BREAK = (Line(""), Line(""))
+
+def min_first_line_width(list_arg, first_item):
+    "Return lower bound for the width of the first line of a non-empty list formatted by list_arg"
+    start = list_arg.get("start", [])
+    if 1 < len(start): # line break after start?
+        return len(start[0].string)
+    return sum(map(lambda line: len(line.string), start)) + first_item.min_first_line_width
 
 class InlinableList(ListBase):
+    __slots__ = ("min_inlined_width",)
+    def __init__(self, *args):
+        super(InlinableList, self).__init__(*args)
+        # Lower bound for the width of the first line when inlined
+        self.min_inlined_width = 0
     def inlinable(self):
         has_comments = find_in_list(lambda node: node.comments or isinstance(node, Comment),
                                     self.items)
         return not has_comments
+    def set_widths(self, options):
+        inlined_args, lined_args = self._inlined_and_lined_list_args(options)
+        items = self.items
+        if not self.may_be_single_line():
+            return
+        if not items:
+            # Both list args have the same empty lines. Argument list may be braceless, which makes
+            # this a lower bound for it.
+            self.flat_width = len(inlined_args.get("empty", [Line("")])[0].string)
+            self.min_first_line_width = self.flat_width
+            self.has_single_layout = True
+            return
+        self.min_first_line_width = min(min_first_line_width(inlined_args, items[0]),
+                                        min_first_line_width(lined_args, items[0]))
+        if not self.inlinable():
+            return
+        start_width = len(inlined_args["start"][0].string)
+        separator_width = len(inlined_args["terminator"]) + len(inlined_args["join_by"][0].string)
+        # Items may be line broken, so only the items until the first such item are known to be on
+        # the first line
+        width = start_width
+        for item in items:
+            if not item.has_single_layout:
+                width += item.min_first_line_width
+                break
+            width += item.flat_width + separator_width
+        else:
+            width += len(inlined_args["end"][0].string) - separator_width
+        self.min_inlined_width = width
+        if all(map(lambda item: item.flat_width != None, items)):
+            self.flat_width = (start_width
+                               + sum(map(lambda item: item.flat_width, items))
+                               + separator_width * (len(items) - 1)
+                               + len(inlined_args["end"][0].string))
+            self.has_single_layout = len(items) == 1 and items[0].has_single_layout
     def list_args(self, options):
         inlined_args, lined_args = self._inlined_and_lined_list_args(options)
         if not self.inlinable():
             return [lined_args]
         elif  1 < len(self.items): # don't line-break a list with just one element
-            return [inlined_args, lined_args]
+            # The inlined list is not rendered if it cannot fit
+            return [merged_dicts(inlined_args, { "min_width" : self.min_inlined_width }),
+                    lined_args]
         else:
             return [inlined_args]
     def _inlined_and_lined_list_args(self, options):
@@ -793,50 +1318,72 @@ class InlinableList(ListBase):
         """
         raise RuntimeError("To be implemented by deriving class")
 
-LIST_ARGS = ({ "join_by" : [Line(" ")],
+LIST_ARGS = ({ "join_by" : (Line(" "),),
                "terminator" : ",",
-               "empty" : [Line("{}")],
-               "start" : [Line("{ ")],
-               "end" : [Line(" }")],
+               "empty" : (Line("{}"),),
+               "start" : (Line("{ "),),
+               "end" : (Line(" }"),),
                "respects_preceding_empty_line_fn" : lambda is_first: False },
              # lined version
              { "postfix_by" : LINE_BREAK,
                "terminator" : ",",
                "end_terminator" : ",",
-               "empty" : [Line("{}")],
-               "start" : [Line("{"), Line("")],
-               "end" : [Line("}")],
+               "empty" : (Line("{}"),),
+               "start" : (Line("{"), Line("")),
+               "end" : (Line("}"),),
                "respects_preceding_empty_line_fn" : lambda is_first: not is_first })
 class List(InlinableList):
+    __slots__ = ()
     def _inlined_and_lined_list_args(self, options):
         return LIST_ARGS
 
-ARGUMENT_LIST_ARGS = ({ "join_by" : [Line(" ")],
+ARGUMENT_LIST_ARGS = ({ "join_by" : (Line(" "),),
                         "terminator" : ",",
-                        "start" : [Line("(")],
-                        "end" : [Line(")")] },
+                        "start" : (Line("("),),
+                        "end" : (Line(")"),) },
                       { "join_by" : LINE_BREAK,
                         "terminator" : ",",
                         "end_terminator" : ")",
-                        "start" : [Line("(")],
+                        "start" : (Line("("),),
                         # 1 == len("(") })
                         "depth_fn" : lambda list, node: 1 })
 # This version of ARGUMENT_LIST_ARGS prevents empty argument list for functions
 ARGUMENT_LIST_ARGS_NON_BRACELESS = tuple(map(lambda arg: merged_dicts(arg,
-                                                                      { "empty" : [Line("()")] }),
+                                                                      { "empty" : (Line("()"),) }),
                                          ARGUMENT_LIST_ARGS))
 class ArgumentList(InlinableList):
+    __slots__ = ()
     def _inlined_and_lined_list_args(self, options):
         if not options.allow_braceless_argument_list:
             return ARGUMENT_LIST_ARGS_NON_BRACELESS
         return ARGUMENT_LIST_ARGS
 
+SPECIFICATION_LIST_ARGS = ({ "join_by" : LINE_BREAK,
+                             "postfix_by" : LINE_BREAK },)
 class Specification(ListBase):
+    __slots__ = ()
     def list_args(self, options):
-        return [{ "join_by" : LINE_BREAK,
-                  "postfix_by" : LINE_BREAK }]
-
-def class_list_depth_fn(default_class_tab_depth, class_of_intended_node):
+        return SPECIFICATION_LIST_ARGS
+    def item_strings(self, options, items = None):
+        """
+        Return the beautified strings of items (bundles, bodies and standalone comments), all items
+        by default. Joined by empty lines and followed by a line break, they are the same as
+        to_string.
+        """
+        item_options = options.child(respects_preceding_empty_line = None)
+        return [item.to_string(item_options) for item in (self.items if items is None else items)]
+    def iter_chunks(self, options):
+        "Render one item at a time, so that only the lines of one item are in memory at once"
+        item_options = options.child(respects_preceding_empty_line = None)
+        line_endings = options.line_endings or "\n"
+        for index, item in enumerate(self.items):
+            if index:
+                yield line_endings * 2
+            yield item.to_string(item_options)
+        if self.items:
+            yield line_endings
+
+def class_list_depth_fn(default_class_tab_depth):
     def class_list_depth(list, node):
         """
         Tab depth function (for ListBase list_arg) for when list constains Classes and something else.
@@ -850,18 +1397,12 @@ def class_list_depth_fn(default_class_tab_depth, class_of_intended_node):
                 # Default indentation for Class is 2 * tab space, so assume anything above that to be
                 # on promise level. Also, it there are any promises before the next class, assume
                 # the comment belongs to the promise level.
-                comment_index = list.items.index(node)
-                has_previous_intended_node = find_index(isinstance_fn(class_of_intended_node),
-                                                        list.items,
-                                                        start_index = comment_index,
-                                                        reverse = True) != None
-                next_class_index = find_index(isinstance_fn(Class), list.items,
-                                              start_index = comment_index, not_found = sys.maxsize)
-                next_promise_index = find_index(isinstance_fn(class_of_intended_node), list.items,
-                                                start_index = comment_index, not_found = sys.maxsize)
-                if next_promise_index < next_class_index:
+                sibling_indexes = list.sibling_indexes
+                comment_index = sibling_indexes.index_by_item[node]
+                if (sibling_indexes.next_intended_node_indexes[comment_index]
+                      < sibling_indexes.next_class_indexes[comment_index]):
                     return 2
-                if not has_previous_intended_node:
+                if not sibling_indexes.has_previous_intended_nodes[comment_index]:
                     return 1
                 return 1 if node.original_indentation <= TAB_SIZE * default_class_tab_depth else 2
             else:
@@ -869,18 +1410,43 @@ def class_list_depth_fn(default_class_tab_depth, class_of_intended_node):
         return tab_depth() * TAB_SIZE
     return class_list_depth
 
+class SiblingIndexes(object):
+    """
+    For each item of a list that contains Classes and something else (intended nodes, e.g.,
+    Promises): the index of the next Class and of the next intended node (sys.maxsize if none), and
+    whether there is an intended node before the item. Counts the item itself.
+    """
+    def __init__(self, items, class_of_intended_node):
+        self.index_by_item = dict((item, index) for index, item in enumerate(items))
+        self.next_class_indexes = [sys.maxsize] * len(items)
+        self.next_intended_node_indexes = [sys.maxsize] * len(items)
+        self.has_previous_intended_nodes = [False] * len(items)
+        next_class_index = next_intended_node_index = sys.maxsize
+        for index in range(len(items) - 1, -1, -1):
+            if isinstance(items[index], Class):
+                next_class_index = index
+            elif isinstance(items[index], class_of_intended_node):
+                next_intended_node_index = index
+            self.next_class_indexes[index] = next_class_index
+            self.next_intended_node_indexes[index] = next_intended_node_index
+        has_previous_intended_node = False
+        for index, item in enumerate(items):
+            has_previous_intended_node = (has_previous_intended_node
+                                          or isinstance(item, class_of_intended_node))
+            self.has_previous_intended_nodes[index] = has_previous_intended_node
+
 # This is a respects_preceding_empty_line_fn function
 def does_not_respect_empty_line_before_first_item(is_first):
     return False if is_first else None
 
 PROMISE_TYPE_LIST_ARGS, CLASS_SELECTION_LIST_ARGS = (
-  map(lambda dict: [merged_dicts(dict, { "postfix_by" : LINE_BREAK,
-                                         "empty" : [Line(" {"), Line("}")],
-                                         "start" : [Line(" {"), Line("")],
-                                         "end" : [Line("}")] })],
+  map(lambda dict: (merged_dicts(dict, { "postfix_by" : LINE_BREAK,
+                                         "empty" : (Line(" {"), Line("}")),
+                                         "start" : (Line(" {"), Line("")),
+                                         "end" : (Line("}"),) }),),
                                  [{ "join_by" : LINE_BREAK,
                                     "depth_fn" : lambda list, node: TAB_SIZE },
-                                  { "depth_fn" : class_list_depth_fn(1, Selection),
+                                  { "depth_fn" : class_list_depth_fn(1),
                                     "respects_preceding_empty_line_fn" :
                                         # Never empty line before the first class or selection
                                         does_not_respect_empty_line_before_first_item }]))
@@ -894,31 +1460,31 @@ def block_child_list_args(block, options, list_args_base):
     options: options as given to lines function
     list_args_base: Either PROMISE_TYPE_LIST_ARGS (if block is PromiseTypeList)
                     or CLASS_SELECTION_LIST_ARGS (if block is ClassSelectionList)
-    Returns either list_args_base as is, or as modified to include the opening brace comments
+    Returns either list_args_base as is, or a new list args that include the opening brace comments
+    (list_args_base is never modified)
     """
-    open_brace = block["open_brace"]
-    close_brace = block["close_brace"]
-    # Avoid the copy for performance reasons if it is not necessary
+    open_brace = block.open_brace
+    close_brace = block.close_brace
     if open_brace.comments or close_brace.comments:
         # This contains unfortunate duplication of PROMISE_TYPE_LIST_ARGS generation logic
-        list_args = copy.deepcopy(list_args_base)
+        changed_list_arg = {}
 
         if open_brace.comments:
-            open_brace_lines = [Line("")] + open_brace.lines(options)
-            list_args[0]["start"] = open_brace_lines + [Line("")]
+            open_brace_lines = (Line(""),) + open_brace.lines(options)
+            changed_list_arg["start"] = open_brace_lines + (Line(""),)
             empty_lines = open_brace_lines
         else:
-            empty_lines = [Line(" {")]
+            empty_lines = (Line(" {"),)
 
         if close_brace.comments:
             close_brace_lines = close_brace.lines(options)
-            list_args[0]["end"] = close_brace_lines
-            empty_lines.extend(close_brace_lines)
+            changed_list_arg["end"] = close_brace_lines
+            empty_lines += close_brace_lines
         else:
-            empty_lines.append(Line("}"))
+            empty_lines += (Line("}"),)
 
-        list_args[0]["empty"] = empty_lines
-        return list_args
+        changed_list_arg["empty"] = empty_lines
+        return (merged_dicts(list_args_base[0], changed_list_arg),)
     else:
         return list_args_base
 
@@ -927,7 +1493,7 @@ def add_comments_to_block_child_list(block, comments, parents):
     Helper for bundle element list (PromiseTypeList) and body child list (ClassSelectionList)
     to be able to pass possible comments for opening brace. Passes the rest to superclass.
     """
-    open_brace = block["open_brace"]
+    open_brace = block.open_brace
     open_brace_comments, comments = (
         partition(lambda comment:
                       comment.position.start_pos < open_brace.position.start_pos,
@@ -963,8 +1529,10 @@ EVALUATION_ORDER = ["meta:",
                     "replace_patterns:",
                     # common
                     "reports:"]
+EVALUATION_ORDER_INDEX_BY_NAME = dict((name, index) for index, name in enumerate(EVALUATION_ORDER))
 # Items should be PromiseTypes or Comments
 class PromiseTypeList(ListBase):
+    __slots__ = ()
     def add_comments(self, comments, parents):
         add_comments_to_block_child_list(self, comments, parents)
     def after_parse(self, options):
@@ -985,31 +1553,26 @@ class PromiseTypeList(ListBase):
                                 or has_comments(node)),
                            items))
     def _sorted_to_cfengine_evaluation_order(self, items):
-        def promise_index(promise_type):
-            try:
-                return EVALUATION_ORDER.index(promise_type.name())
-            except ValueError:
-                return sys.maxsize
-
-        def with_interleaved_comments(sorted_promise_types, unordered_items, comments):
-            interleaved_items = copy.copy(sorted_promise_types)
-            # process in reverse order, so that interleaved_items always contains the next item,
-            # even if comments follow comments
-            for comment in reversed(comments):
-                original_index = unordered_items.index(comment)
-                if original_index == len(unordered_items) - 1: # last?
-                    # last comment stays last
-                    new_index_of_item = len(interleaved_items)
-                else:
-                    next_item = unordered_items[original_index + 1]
-                    new_index_of_item = interleaved_items.index(next_item)
-                interleaved_items.insert(new_index_of_item, comment)
-            return interleaved_items
-
-        # Sort promises first, then put the comments before the items they were original before
-        promise_types, comments = partition(isinstance_fn(PromiseType), items)
-        sorted_promise_types = sorted(promise_types, key = promise_index)
-        return with_interleaved_comments(sorted_promise_types, items, comments)
+        def promise_index(promise_type_and_comments):
+            return EVALUATION_ORDER_INDEX_BY_NAME.get(promise_type_and_comments[0].name.name,
+                                                      sys.maxsize)
+
+        # Sort promises, and put the comments before the items they were originally before. The
+        # comments after the last promise type stay last.
+        promise_types_and_comments = []
+        comments = []
+        for item in items:
+            if isinstance(item, PromiseType):
+                promise_types_and_comments.append((item, comments))
+                comments = []
+            else:
+                comments.append(item)
+        sorted_items = []
+        for promise_type, comments_before in sorted(promise_types_and_comments,
+                                                    key = promise_index):
+            sorted_items.extend(comments_before)
+            sorted_items.append(promise_type)
+        return sorted_items + comments
     def list_args(self, options):
         return block_child_list_args(self, options, PROMISE_TYPE_LIST_ARGS)
     def is_standalone_comment_for_node(self, item, comment):
@@ -1018,8 +1581,13 @@ class PromiseTypeList(ListBase):
         return TAB_SIZE < comment.original_indentation
 
 class ClassAndSomethingList(ListBase):
+    __slots__ = ("sibling_indexes",)
+    # Class of the items that are indented under classes
+    CLASS_OF_INTENDED_NODE = None
     def after_parse(self, options):
         super(ClassAndSomethingList, self).after_parse(options)
+        # For class_list_depth_fn. The items do not change after parsing.
+        self.sibling_indexes = SiblingIndexes(self.items, self.CLASS_OF_INTENDED_NODE)
         # Never an empty line between class and its first promise
         previous_item = None
         for item in self.items:
@@ -1033,29 +1601,34 @@ class ClassAndSomethingList(ListBase):
 
 # Items should be Classes, Selections or Comments.
 class ClassSelectionList(ClassAndSomethingList):
+    __slots__ = ()
+    CLASS_OF_INTENDED_NODE = Selection
     def add_comments(self, comments, parents):
         add_comments_to_block_child_list(self, comments, parents)
     def list_args(self, options):
         return block_child_list_args(self, options, CLASS_SELECTION_LIST_ARGS)
 
 # Promises are indented as if they are under classes in tree, so deeper
-CLASS_PROMISE_LIST_ARGS = [{ "depth_fn" : class_list_depth_fn(2, Promise),
+CLASS_PROMISE_LIST_ARGS = ({ "depth_fn" : class_list_depth_fn(2),
                              # Never empty line before the first class, promise or comment
                              "respects_preceding_empty_line_fn" :
                                 does_not_respect_empty_line_before_first_item,
-                             "join_by" : LINE_BREAK }]
+                             "join_by" : LINE_BREAK },)
 # for Bundle, elements should be PromiseTypes. For Body, they should be Classes or Selections.
 class ClassPromiseList(ClassAndSomethingList):
+    __slots__ = ()
+    CLASS_OF_INTENDED_NODE = Promise
     def __init__(self, *args):
         super(ClassAndSomethingList, self).__init__(*args)
         self.consumes_preceding_empty_line = False # Github #6
     def list_args(self, options):
         return CLASS_PROMISE_LIST_ARGS
 
-CONSTRAINT_LIST_ARGS = [{ "empty" : [Line(";")],
+CONSTRAINT_LIST_ARGS = ({ "empty" : (Line(";"),),
                           "join_by" : LINE_BREAK,
                           "terminator" : ",",
-                          "end_terminator" : ";" }]
+                          "end_terminator" : ";" },)
 class ConstraintList(ListBase):
+    __slots__ = ()
     def list_args(self, options):
         return CONSTRAINT_LIST_ARGS
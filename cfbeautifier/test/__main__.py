@@ -9,16 +9,29 @@ beautifier_executable_path = os.path.join(this_dir, "cf-beautifier")
 test_cf_dir = os.path.join(this_dir, "test_cfs")
 
 from .. import beautifier
+from .. import blocks
+from .. import cache
+from .. import daemon
+from .. import document
+from .. import files
+from .. import lexer
+from .. import lsp
+from .. import parser
+from .. import session
 from ..color import Color
 from ..version_abstraction import string_from_file
+import io
+import json
 import random
 from .. import structure
-from ..structure import Line
+from ..structure import Line, find_in_list
 from ..util import ParserError
 import re
 import shutil
+import socket
 import subprocess
 import tempfile
+import threading
 import time
 import unittest
 
@@ -56,6 +69,137 @@ class TestStructureHelpers(unittest.TestCase):
         for (message, line_arrays, expected) in test_cases:
           self.assertEqualWithDiff(structure.joined_lines(*line_arrays), expected, message)
 
+    def test_joined_lines_within(self):
+        def never_called():
+            self.fail("Rendered lines after running out of width")
+        self.assertEqualWithDiff(structure.joined_lines_within(12, [Line("string", 1)],
+                                                               lambda: [Line(" more")]),
+                                 [Line("string more", 1)], "Joins lines that fit")
+        self.assertEqualWithDiff(structure.joined_lines_within(11, [Line("string", 1)],
+                                                               [Line(" more")], never_called),
+                                 None, "Stops when a line does not fit")
+        self.assertEqualWithDiff(structure.joined_lines_within(None, [Line("string", 1)],
+                                                               [Line(" more")]),
+                                 [Line("string more", 1)], "Has no limit without width budget")
+
+    def test_indented_lines(self):
+        options = structure.Options(beautifier.Options()).child(3)
+        lines = [Line("first", None), Line("second", None), Line("third", 1)]
+        self.assertEqualWithDiff(options.indented_lines(lines),
+                                 [Line("first", None), Line("second", 3), Line("third", 4)],
+                                 "Indents all but the first line")
+        self.assertEqualWithDiff(lines,
+                                 [Line("first", None), Line("second", None), Line("third", 1)],
+                                 "Does not modify the given lines")
+
+    def test_options_are_values(self):
+        settings = beautifier.Options()
+        options = structure.Options(settings)
+        child = options.child(2).child([Line("abc", 1)])
+        self.assertEqualWithDiff((child.indent, child.ancestor_indent), (4, 2),
+                                 "Child is indented by the given lines and char counts")
+        self.assertEqualWithDiff(child, structure.Options(settings, indent = 4, ancestor_indent = 2),
+                                 "Equal to options with the same layout")
+        self.assertEqualWithDiff(hash(child),
+                                 hash(structure.Options(settings, indent = 4, ancestor_indent = 2)),
+                                 "Hashes by value")
+        self.assertEqualWithDiff(options.indent, 0, "Does not modify the parent")
+        self.assertEqualWithDiff(child.page_width, settings.page_width, "Has the settings")
+
+    def test_lines_are_cached_by_layout(self):
+        options = structure.Options(beautifier.Options())
+        specification = parser.specification_from_string('bundle agent foo { vars: "x"; }', options)
+        promise = find_in_list(structure.isinstance_fn(structure.Promise),
+                               specification.descendants())
+        lines = promise.lines(options)
+        self.assertEqualWithDiff(lines, (Line('"x";', 0),), "Renders lines")
+        self.assertTrue(lines is promise.lines(options.child()), "Reuses lines for same layout")
+        self.assertFalse(lines is promise.lines(options.child(2)), "Renders for different layout")
+        self.assertTrue(lines is promise.lines(options), "Keeps lines of all layouts")
+
+    def test_list_args_are_not_modified(self):
+        cf_string = """bundle agent foo { # comment
+                         vars:
+                           "x" slist => { "a", "b" };
+                       }"""
+        for page_width in [10, 100]:
+            options = beautifier.Options()
+            options.page_width = page_width
+            beautifier.beautified_string(cf_string, options)
+        self.assertEqualWithDiff(structure.PROMISE_TYPE_LIST_ARGS[0]["start"],
+                                 (Line(" {"), Line("")), "Does not modify block list args")
+        self.assertEqualWithDiff(structure.LIST_ARGS[0]["join_by"], (Line(" "),),
+                                 "Does not modify list args")
+
+    def test_widths(self):
+        def list_in(cf_string):
+            options = structure.Options(beautifier.Options())
+            specification = parser.specification_from_string(cf_string, options)
+            return find_in_list(structure.isinstance_fn(structure.List),
+                                specification.descendants())
+        flat_list = list_in("""bundle agent foo {
+                                 vars:
+                                   "x" slist => { "a", f("b", c) };
+                               }""")
+        self.assertEqualWithDiff(flat_list.flat_width, len('{ "a", f("b", c) }'),
+                                 "Knows width on single line")
+        self.assertEqualWithDiff(flat_list.min_inlined_width, len('{ "a", f("b"'),
+                                 "Knows width of first line until a part that may be line broken")
+        commented_list = list_in("""bundle agent foo {
+                                      vars:
+                                        "x" slist => { "a", # comment
+                                                       "b" };
+                                    }""")
+        self.assertEqualWithDiff(commented_list.flat_width, None,
+                                 "Cannot be on single line if has comments")
+
+    def test_node_lines(self):
+        def last_nodes_on_lines(*line_spans):
+            node_lines = structure.NodeLines([structure.Node(structure.Position(start, end, 0, 0))
+                                              for start, end in line_spans])
+            return [[index for index in range(len(line_spans))
+                     if node_lines.is_last_on_line(index, line_number)]
+                    for line_number in range(1, 8)]
+        self.assertEqualWithDiff(last_nodes_on_lines((1, 2), (2, 2), (2, 4), (6, 6)),
+                                 [[0], [2], [2], [2], [], [3], []],
+                                 "Finds the last node on each line")
+        self.assertEqualWithDiff(last_nodes_on_lines((2, 4), (1, 2), (2, 2), (6, 6)),
+                                 [[1], [2], [0], [0], [], [3], []],
+                                 "Finds the last node on each line of nodes out of order")
+
+    def test_quoted_string_end(self):
+        for string, expected in [('"ab" c', 4), ("'a\\'b' c", 6), ('"a\\\\" c', 5), ('`a\\` c', 4),
+                                 ('"a\n\\\nb"', 7), ('"a\\"', -1), ("'a\\", -1), ("`a", -1)]:
+            self.assertEqualWithDiff(lexer.quoted_string_end(string, 0), expected,
+                                     "Finds the end of %r" % string)
+
+    def test_render_document(self):
+        choice = document.IfFits([document.Concat(document.Text("a "), document.Text("b")),
+                                  document.Concat(document.Text("a"),
+                                                  document.LineBreak(),
+                                                  document.Text("b", 2))])
+        nested = document.Concat(document.Text("x("),
+                                 document.Nest(2, choice),
+                                 document.EndComment(" # end"))
+        self.assertEqualWithDiff(document.render(nested, 5), ["x(a b # end"],
+                                 "Chooses first alternative that fits")
+        self.assertEqualWithDiff(document.render(nested, 4), ["x(a", "    b # end"],
+                                 "Indents line breaks by nesting and Text indent")
+        self.assertEqualWithDiff(document.last_line_width(document.Concat(document.Text("x("),
+                                                                          document.LineBreak(),
+                                                                          document.Text("ab", 2))),
+                                 4, "Measures last line")
+
+    def test_lexers_are_independent(self):
+        first_lexer = lexer.lexer()
+        first_lexer.input("# comment\nbundle")
+        tokens = [token.type for token in iter(first_lexer.token, None)]
+        self.assertEqualWithDiff(tokens, ["BUNDLE"], "Lexes tokens")
+        self.assertEqualWithDiff(len(first_lexer.comments), 1, "Collects comments")
+        second_lexer = lexer.lexer()
+        self.assertEqualWithDiff((second_lexer.lineno, second_lexer.comments), (1, []),
+                                 "Starts from the beginning")
+
     def test_find_index(self):
         self.assertEqualWithDiff(structure.find_index(lambda x: x == 3, [1, 2, 3, 4]),
                                  2, "Finds in middle of list")
@@ -169,6 +313,229 @@ class TestEndToEnd(unittest.TestCase):
 
         self._for_original_and_expected_in_each_cf_file(compare)
 
+    def test_document_layout_engine(self):
+        def compare(original_cf_string, expected, cf_file_name):
+            for page_width in [40, 80, 100, 140]:
+                options = beautifier.Options()
+                options.page_width = page_width
+                lines_engine_output = beautifier.beautified_string(original_cf_string, options)
+                options.layout_engine = "document"
+                self.assertEqualLines(beautifier.beautified_string(original_cf_string, options),
+                                      lines_engine_output,
+                                      "%s (page width %d)" % (cf_file_name, page_width))
+
+        self._for_original_and_expected_in_each_cf_file(compare)
+
+    def test_beautify_in_threads(self):
+        expected_by_original = {}
+        def collect(original_cf_string, expected, cf_file_name):
+            expected_by_original[original_cf_string] = expected
+        self._for_original_and_expected_in_each_cf_file(collect)
+        originals = list(expected_by_original.keys()) * 5
+        errors = []
+        def beautify(thread_originals):
+            try:
+                for original in thread_originals:
+                    if beautifier.beautified_string(original) != expected_by_original[original]:
+                        errors.append("Wrong output")
+            except Exception as error:
+                errors.append(error)
+
+        # Each thread beautifies the files in different order, so that different parses overlap
+        threads = [threading.Thread(target = beautify, args = (originals[index:] + originals[:index],))
+                   for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors, "Beautifying in many threads at once is like one by one")
+
+    def test_blocks(self):
+        cf_string = "# a\nbundle agent a {\n} # end a\n\nbody x b { y => { z } ; } bundle agent c {\n}\n#"
+        self.assertEqual([cf_string[start:end] for start, end in blocks.regions(cf_string)],
+                         ["# a\nbundle agent a {\n} # end a\n",
+                          "\nbody x b { y => { z } ; } bundle agent c {\n}\n#"],
+                         "Splits after the lines of closing braces of bundles and bodies")
+        scanner_options = beautifier.Options()
+        scanner_options.lexer = "scanner"
+        self.assertEqual(blocks.regions(cf_string, scanner_options), blocks.regions(cf_string),
+                         "Splits with the lexer of the options")
+        self.assertEqual(blocks.regions("bundle agent a {\n} # end a\n", is_followed_by_block = True),
+                         [(0, 27), (27, 27)], "Ends a region at the end of a part of a document")
+        try:
+            blocks.beautified_string("bundle agent a {\n}\nbundle agent b {\n  vars: => }\n")
+        except ParserError as error:
+            self.assertEqual((error.line_number, error.position), (4, 44),
+                             "Tells the position of the error in the document")
+        else:
+            self.fail("Did not raise ParserError")
+
+        def compare(original_cf_string, expected, cf_file_name):
+            try:
+                beautified = beautifier.beautified_string(original_cf_string)
+            except ParserError:
+                return
+            self.assertEqualLines(blocks.beautified_string(original_cf_string), beautified,
+                                  cf_file_name)
+
+        self._for_original_and_expected_in_each_cf_file(compare)
+
+    def test_scanner(self):
+        def tokens(the_lexer, cf_string):
+            the_lexer.input(cf_string)
+            try:
+                result = [(token.type, token.value, token.lineno, token.lexpos)
+                          for token in iter(the_lexer.token, None)]
+            except ParserError as error:
+                result = [str(error), error.position]
+            return result + [(comment.value, comment.lineno, comment.lexpos)
+                             for comment in the_lexer.comments]
+
+        def compare(original_cf_string, expected, cf_file_name):
+            self.assertEqual(tokens(lexer.scanner(), original_cf_string),
+                             tokens(lexer.lexer(), original_cf_string), cf_file_name)
+            options = beautifier.Options()
+            options.lexer = "scanner"
+            try:
+                beautified = beautifier.beautified_string(original_cf_string)
+            except ParserError:
+                return
+            self.assertEqualLines(beautifier.beautified_string(original_cf_string, options),
+                                  beautified, cf_file_name)
+
+        self._for_original_and_expected_in_each_cf_file(compare)
+        for cf_string in ["", " \r\n", "# a \r\n  $(x)::", "\"a\\\"\nb\" 'c\n", " \t\n %"]:
+            compare(cf_string, None, repr(cf_string))
+
+    def test_chunks(self):
+        def compare(original_cf_string, expected, cf_file_name):
+            for layout_engine in ["lines", "document"]:
+                options = beautifier.Options()
+                options.layout_engine = layout_engine
+                try:
+                    beautified = beautifier.beautified_string(original_cf_string, options)
+                except ParserError:
+                    return
+                self.assertEqualLines("".join(beautifier.iter_chunks(original_cf_string, options)),
+                                      beautified, cf_file_name)
+                stream = io.StringIO()
+                blocks.write_to(stream, original_cf_string, options)
+                self.assertEqualLines(stream.getvalue(), beautified, cf_file_name)
+
+        self._for_original_and_expected_in_each_cf_file(compare)
+
+    def test_stream(self):
+        class Stream(io.StringIO):
+            "Tells how much is read"
+            def readline(self):
+                line = super(Stream, self).readline()
+                self.read_length = self.tell()
+                return line
+
+        def compare(original_cf_string, expected, cf_file_name):
+            try:
+                beautified = beautifier.beautified_string(original_cf_string)
+            except ParserError:
+                return
+            if beautifier.line_endings(original_cf_string.split("\n")[0] + "\n", None) \
+                   != beautifier.line_endings(original_cf_string, None):
+                return # Line endings are detected from the first line
+            stream = Stream(original_cf_string)
+            chunks = []
+            for chunk in blocks.iter_stream_chunks(stream):
+                if not chunks and 1 < len(blocks.regions(original_cf_string)):
+                    self.assertTrue(stream.read_length < len(original_cf_string),
+                                    "Yields the first region before reading everything")
+                chunks.append(chunk)
+            self.assertEqualLines("".join(chunks), beautified, cf_file_name)
+
+        self._for_original_and_expected_in_each_cf_file(compare)
+
+        for line in ['  vars: $\n', '  vars: "x" string => "y" => "z";\n']:
+            cf_string = "bundle agent a {\n" + line + "}\n" + "bundle agent b {\n}\n" * 1000
+            stream = Stream(cf_string)
+            self.assertRaises(ParserError, list, blocks.iter_stream_chunks(stream))
+            self.assertTrue(stream.read_length < 1000, "Raises the error without reading the rest")
+
+    def test_blocks_in_parallel(self):
+        cf_strings = []
+        def add(original_cf_string, expected, cf_file_name):
+            try:
+                beautifier.beautified_string(original_cf_string)
+            except ParserError:
+                return
+            cf_strings.append(original_cf_string)
+        self._for_original_and_expected_in_each_cf_file(add)
+        cf_string = "\n".join(cf_strings)
+        self.assertEqualLines(blocks.beautified_string(cf_string, jobs = 2),
+                              beautifier.beautified_string(cf_string),
+                              "Beautifies blocks in processes")
+        try:
+            blocks.beautified_string(cf_string + "bundle agent b {\n  vars: => }\n", jobs = 2)
+        except ParserError as error:
+            self.assertEqual((error.line_number, error.position),
+                             (cf_string.count("\n") + 2, len(cf_string) + 25),
+                             "Tells the position of the error in the document")
+        else:
+            self.fail("Did not raise ParserError")
+        cf_string = 'bundle agent a {\n  vars: => }\nbundle agent b {\n  vars: "x\n'
+        for jobs in [1, 2]:
+            try:
+                blocks.beautified_string(cf_string, jobs = jobs)
+            except ParserError as error:
+                self.assertEqual(error.position, cf_string.index("=>"),
+                                 "Tells the syntax error before the lexer error")
+            else:
+                self.fail("Did not raise ParserError")
+
+    def test_session(self):
+        def compare(original_cf_string, expected, cf_file_name):
+            try:
+                the_session = session.Session(original_cf_string)
+            except ParserError:
+                return
+            self.assertEqualLines(the_session.to_string(), expected, cf_file_name)
+            # Edit at the start, in the middle and at the end of each region
+            def region_start(region):
+                return region.start
+            def middle_line_start(region):
+                return max(region.start,
+                           the_session.string.rfind("\n", 0, (region.start + region.end) // 2) + 1)
+            def region_end(region):
+                return region.end
+            for index in range(min(len(the_session.regions), 4)):
+                for offset_fn, string in [(region_start, "\n# comment\n"),
+                                          (middle_line_start, "\n"),
+                                          (region_end, "\n")]:
+                    region = the_session.regions[index]
+                    offset = offset_fn(region)
+                    # An edit inside a region other than the last reparses just it
+                    if (region.start < offset < region.end
+                          and region is not the_session.regions[-1]):
+                        other_regions = [other for other in the_session.regions if other != region]
+                    else:
+                        other_regions = []
+                    other_items = [item for other in other_regions for item in other.items]
+                    the_session.edit(offset, offset, string)
+                    self.assertEqualLines(the_session.to_string(),
+                                          beautifier.beautified_string(the_session.string),
+                                          "%s, region %d" % (cf_file_name, index))
+                    self.assertTrue(set(other_items) <= set(the_session.items()),
+                                    "Does not reparse other regions")
+
+            # Break the document and fix it
+            try:
+                the_session.edit(0, 0, "}")
+            except ParserError:
+                pass
+            else:
+                self.fail("Did not raise ParserError")
+            the_session.edit(0, 1, "")
+            self.assertEqualLines(the_session.to_string(),
+                                  beautifier.beautified_string(the_session.string), cf_file_name)
+
+        self._for_original_and_expected_in_each_cf_file(compare)
+
     def assertBeautifies(self, original, expected, options, message):
         beautified = beautifier.beautified_string(original,
                                                   options = options)
@@ -250,6 +617,208 @@ class TestEndToEnd(unittest.TestCase):
 
         self._for_original_and_expected_in_each_cf_file(compare)
 
+    def test_command_line_interface_with_jobs(self):
+        def beautify_copies(job_count):
+            clear_temp_dir()
+            for cf_file_name in cf_file_names():
+                shutil.copy(cf_file_name, temp_dir)
+            with open(os.path.join(temp_dir, "broken.cf"), "w") as file:
+                file.write("bundle agent {")
+            process = subprocess.Popen(["./cf-beautify", "-v", "-j", str(job_count), temp_dir],
+                                       stdout = subprocess.PIPE,
+                                       stderr = subprocess.PIPE)
+            out, err = process.communicate()
+            return (process.returncode, out.decode("utf-8"), err.decode("utf-8"))
+
+        sequential_result = beautify_copies(1)
+        parallel_result = beautify_copies(3)
+        self.assertEqual(parallel_result, sequential_result,
+                         "Output and exit code do not depend on the number of jobs")
+        self.assertEqual(parallel_result[0], 1, "Fails if some file fails")
+        self.assertTrue("broken.cf: Syntax error" in parallel_result[2], "Tells which file failed")
+        def compare(original_cf_string, expected, cf_file_name):
+            beautified = string_from_file(os.path.join(temp_dir, os.path.basename(cf_file_name)))
+            self.assertEqualLines(beautified, expected, cf_file_name)
+
+        self._for_original_and_expected_in_each_cf_file(compare)
+
+    def test_cache(self):
+        clear_temp_dir()
+        cache_dir = os.path.join(temp_dir, "cache")
+        path = os.path.join(temp_dir, "test.cf")
+        with open(path, "w") as file:
+            file.write("bundle agent foo {\n}\n")
+        def beautify_with_cache(options, uses_stat = False):
+            file_cache = cache.Cache(options, directory = cache_dir, uses_stat = uses_stat)
+            results = list(files.beautify_files([path], options, cache = file_cache))
+            file_cache.save()
+            return (file_cache.hit_count, file_cache.stat_hit_count, file_cache.miss_count,
+                    results[0].is_changed)
+
+        options = beautifier.Options()
+        self.assertEqual(beautify_with_cache(options), (0, 0, 1, False), "Misses empty cache")
+        self.assertEqual(beautify_with_cache(options), (1, 0, 0, False), "Hits beautified file")
+        options.page_width = 50
+        self.assertEqual(beautify_with_cache(options), (0, 0, 1, False), "Misses other options")
+        self.assertEqual(beautify_with_cache(options, uses_stat = True), (1, 0, 0, False),
+                         "Records file stat")
+        self.assertEqual(beautify_with_cache(options, uses_stat = True), (0, 1, 0, False),
+                         "Hits by file stat")
+        with open(path, "w") as file:
+            file.write("bundle agent foo { }\n")
+        self.assertEqual(beautify_with_cache(options, uses_stat = True), (0, 0, 1, True),
+                         "Misses changed file")
+        self.assertEqual(string_from_file(path), "bundle agent foo {\n}\n", "Beautifies the file")
+        self.assertEqual(beautify_with_cache(options, uses_stat = True), (0, 1, 0, False),
+                         "Records the rewritten file")
+
+        file_cache = cache.Cache(options, directory = cache_dir, max_entry_count = 1)
+        file_cache.add_beautified(path)
+        file_cache.save()
+        self.assertEqual(len(cache.Cache(options, directory = cache_dir).last_use_by_key), 1,
+                         "Evicts entries above the maximum count")
+
+    def test_write_chunks(self):
+        clear_temp_dir()
+        path = os.path.join(temp_dir, "test.cf")
+        with open(path, "w") as file:
+            file.write("original\n")
+        def failing_chunks():
+            yield "partial\n"
+            raise ParserError("x", 1, "x", 0)
+        self.assertRaises(ParserError, files.write_chunks, path, failing_chunks())
+        self.assertEqual((string_from_file(path), os.listdir(temp_dir)), ("original\n", ["test.cf"]),
+                         "Leaves the file as it was if fails")
+        files.write_chunks(path, ["new", "\n"])
+        self.assertEqual((string_from_file(path), os.listdir(temp_dir)), ("new\n", ["test.cf"]),
+                         "Replaces the file")
+
+    def test_daemon(self):
+        clear_temp_dir()
+        socket_path = os.path.join(temp_dir, "daemon", "daemon.sock")
+        original = "bundle agent foo { }"
+        expected = beautifier.beautified_string(original)
+        self.assertEqual(daemon.beautified_string(original, socket_path = socket_path), expected,
+                         "Beautifies in process without daemon")
+
+        server = daemon.Server(socket_path, cache_size = 2)
+        thread = threading.Thread(target = server.serve_forever)
+        thread.start()
+        try:
+            self.assertEqual(os.stat(os.path.dirname(socket_path)).st_mode & 0o777, 0o700,
+                             "Creates the directory accessible only by the user")
+            self.assertEqual(os.stat(socket_path).st_mode & 0o777, 0o600,
+                             "Creates the socket accessible only by the user")
+            outputs = []
+            def beautify():
+                outputs.append(daemon.beautified_string(original, socket_path = socket_path))
+            threads = [threading.Thread(target = beautify) for index in range(8)]
+            for client_thread in threads:
+                client_thread.start()
+            for client_thread in threads:
+                client_thread.join()
+            self.assertEqual(outputs, [expected] * 8, "Serves concurrent requests")
+            self.assertEqual(len(server.responses.values), 1, "Keeps recent responses")
+            # Connect without sending anything, as when checking that the daemon is running
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(socket_path)
+            connection.close()
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(socket_path)
+            connection.sendall(b"{}\n")
+            self.assertEqual(list(json.loads(connection.makefile("rb").readline().decode("utf-8"))),
+                             ["error"], "Answers an invalid request with an error")
+            connection.close()
+            self.assertEqual(daemon.beautified_string(original, socket_path = socket_path), expected,
+                             "Keeps serving after invalid requests")
+            try:
+                daemon.beautified_string("bundle agent foo {", socket_path = socket_path)
+            except ParserError as error:
+                self.assertEqual(str(error), "Syntax error, line 0, column 1: 'End of file'",
+                                 "Passes the error from the daemon")
+            else:
+                self.fail("Did not raise ParserError")
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertFalse(os.path.exists(socket_path), "Removes the socket")
+
+        # Listens, but never answers
+        stuck_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            stuck_socket.bind(socket_path)
+            stuck_socket.listen(1)
+            self.assertEqual(daemon.beautified_string(original, socket_path = socket_path,
+                                                      timeout = 0.1),
+                             expected, "Beautifies in process if the daemon does not answer")
+        finally:
+            stuck_socket.close()
+
+    def test_language_server(self):
+        uri = "file:///test.cf"
+        requests = [{ "id" : 1, "method" : "initialize",
+                      "params" : { "initializationOptions" : { "page_width" : 60 } } },
+                    { "method" : "textDocument/didOpen",
+                      "params" : { "textDocument" : { "uri" : uri, "text" : "bundle agent a {\n" } } },
+                    # Fix the syntax error and add a bundle
+                    { "method" : "textDocument/didChange",
+                      "params" : { "textDocument" : { "uri" : uri },
+                                   "contentChanges" : [{ "range" : { "start" : { "line" : 1,
+                                                                                 "character" : 0 },
+                                                                     "end" : { "line" : 1,
+                                                                               "character" : 0 } },
+                                                         "text" : "}\nbundle  agent  b {\n}\n" }] } },
+                    { "id" : 2, "method" : "textDocument/rangeFormatting",
+                      "params" : { "textDocument" : { "uri" : uri },
+                                   "range" : { "start" : { "line" : 2, "character" : 0 },
+                                               "end" : { "line" : 2, "character" : 1 } } } },
+                    { "id" : 3, "method" : "textDocument/formatting",
+                      "params" : { "textDocument" : { "uri" : uri } } },
+                    { "id" : 5, "method" : "textDocument/formatting",
+                      "params" : { "textDocument" : { "uri" : "file:///unknown.cf" } } },
+                    { "method" : "textDocument/didChange",
+                      "params" : { "textDocument" : { "uri" : "file:///unknown.cf" },
+                                   "contentChanges" : [{ "text" : "" }] } },
+                    { "id" : 4, "method" : "shutdown" },
+                    { "method" : "exit" }]
+        input = b"".join(b"Content-Length: %d\r\n\r\n" % len(body) + body
+                         for body in [json.dumps(request).encode("utf-8") for request in requests])
+        output = io.BytesIO()
+        log = io.StringIO()
+        lsp.Server(io.BytesIO(input), output, log = log).serve()
+        responses = [json.loads(body.decode("utf-8"))
+                     for body in re.split(b"Content-Length: \\d+\r\n\r\n", output.getvalue())[1:]]
+
+        self.assertEqual(responses[0]["result"]["capabilities"]["documentRangeFormattingProvider"],
+                         True, "Tells capabilities")
+        diagnostic = responses[1]["params"]["diagnostics"][0]
+        self.assertEqual((diagnostic["range"]["start"], diagnostic["message"]),
+                         ({ "line" : 1, "character" : 0 },
+                          "Syntax error, line 0, column 1: 'End of file'"),
+                         "Publishes syntax error")
+        self.assertEqual(responses[2]["params"]["diagnostics"], [], "Clears fixed syntax error")
+        self.assertEqual(responses[3]["result"],
+                         [{ "range" : { "start" : { "line" : 2, "character" : 0 },
+                                        "end" : { "line" : 4, "character" : 0 } },
+                            "newText" : "\nbundle agent b {\n}\n" }],
+                         "Formats bundles in range")
+        self.assertEqual(responses[4]["result"][0]["newText"],
+                         "bundle agent a {\n}\n\nbundle agent b {\n}\n",
+                         "Formats document")
+        self.assertEqual(responses[5]["error"]["code"], lsp.INVALID_PARAMS,
+                         "Answers request for unknown document with error")
+        self.assertEqual(log.getvalue(),
+                         "textDocument/didChange: Unknown document: file:///unknown.cf\n",
+                         "Logs error in notification")
+        self.assertEqual(responses[6], { "jsonrpc" : "2.0", "id" : 4, "result" : None },
+                         "Keeps serving after errors")
+
+        document = lsp.Document("a\r\nbc\n", beautifier.Options())
+        self.assertEqual([document.offset({ "line" : line, "character" : character })
+                          for line, character in [(0, 1), (0, 5), (1, 5), (2, 0), (3, 0)]],
+                         [1, 1, 5, 6, 6], "Clamps positions to the end of the line")
+
 def beautified_via_cli(args, input):
     process = subprocess.Popen(["./cf-beautify"] + args,
                                stdin = subprocess.PIPE,
@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# Benchmarks, run with: python -m cfbeautifier.test.benchmark [benchmark name ...]
+
+import os
+import subprocess
+import sys
+import time
+
+def generated_policy(bundle_count):
+    "Return a policy with bundle_count bundles, which have the common kinds of promises"
+    bundles = []
+    for index in range(bundle_count):
+        bundles.append("""# Bundle number %(index)d
+bundle agent bundle_%(index)d(path)
+{
+vars:
+  "packages_%(index)d" slist => { "package-a-%(index)d", "package-b", "package-c",
+                                   "package-d", "package-e", "package-f" };
+  "name" string => concat("prefix", "$(path)", canonify("name_%(index)d")); # end of line
+
+  linux::
+  # Comment for the next promise
+  "config" data => parsejson('{ "key": "value" }');
+
+files:
+  "$(path)/file_%(index)d"
+    create => "true",
+    perms => mog("644", "root", "root"),
+    edit_line => insert_lines("line %(index)d");
+
+packages:
+  "$(packages_%(index)d)" -> { "owner" }
+    package_policy => "add",
+    package_method => generic;
+}
+""" % { "index" : index })
+    return "\n".join(bundles)
+
+def memory_in_child_process(kilobyte_count):
+    """
+    Beautify a generated policy of about kilobyte_count KB in a new process, and return
+    (input size in KB, peak RSS before beautifying in KB, peak RSS after beautifying in KB)
+    """
+    script = """
+from cfbeautifier import beautifier
+from cfbeautifier.test import benchmark
+import resource, sys
+policy = benchmark.generated_policy(int(%d / len(benchmark.generated_policy(1)) * 1024))
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 if sys.platform == "darwin" else rss # bytes on OS X, otherwise KB
+before = peak_rss()
+beautifier.beautified_string(policy)
+print(len(policy) / 1024.0, before, peak_rss())
+""" % kilobyte_count
+    output = subprocess.check_output([sys.executable, "-c", script],
+                                     cwd = os.path.join(os.path.dirname(__file__), "..", ".."))
+    return tuple(map(float, output.split()))
+
+def benchmark_memory():
+    "Peak RSS growth per KB of input when beautifying"
+    for kilobyte_count in [100, 400]:
+        input_kilobytes, before, after = memory_in_child_process(kilobyte_count)
+        print("%6d KB input: peak RSS %6d KB -> %6d KB, %5.1f KB per input KB"
+                  % (input_kilobytes, before, after, (after - before) / input_kilobytes))
+
+def benchmark_time():
+    "Time to beautify"
+    from .. import beautifier
+    policy = generated_policy(200)
+    start = time.time()
+    beautifier.beautified_string(policy)
+    print("%6d KB input: %.2f s" % (len(policy) / 1024, time.time() - start))
+
+def benchmark_blocks():
+    "Time to beautify with blocks in parallel"
+    from .. import blocks
+    from .. import files
+    policy = generated_policy(200)
+    for jobs in sorted(set([1, files.default_job_count()])):
+        start = time.time()
+        blocks.beautified_string(policy, jobs = jobs)
+        print("%6d KB input, %2d jobs: %.2f s" % (len(policy) / 1024, jobs, time.time() - start))
+
+def benchmark_lexers():
+    "Tokens per second of the lexers"
+    from .. import lexer
+    policy = generated_policy(200)
+    for name, new_lexer in [("ply", lexer.lexer), ("scanner", lexer.scanner)]:
+        start = time.time()
+        the_lexer = new_lexer()
+        the_lexer.input(policy)
+        token_count = sum(1 for token in iter(the_lexer.token, None))
+        print("%8s: %8d tokens per second" % (name, token_count / (time.time() - start)))
+
+def benchmark_strings():
+    "Time to lex long strings that end and that do not end"
+    from .. import lexer
+    from ..util import ParserError
+    for character_count in [1000000, 4000000]:
+        content = 'a\\"b\n' * (character_count // 5)
+        for name, string in [("string", '"%s"' % content), ("unterminated string", '"' + content)]:
+            start = time.time()
+            the_lexer = lexer.lexer()
+            the_lexer.input(string)
+            try:
+                the_lexer.token()
+            except ParserError:
+                pass
+            print("%7d KB %20s: %.3f s" % (len(string) / 1024, name, time.time() - start))
+
+def benchmark_small_files():
+    "Time to beautify a small file"
+    from .. import beautifier
+    policy = generated_policy(1)
+    count = 300
+    start = time.time()
+    for index in range(count):
+        beautifier.beautified_string(policy)
+    print("%6.2f ms per file" % ((time.time() - start) / count * 1000))
+
+BENCHMARKS = [("memory", benchmark_memory),
+              ("time", benchmark_time),
+              ("blocks", benchmark_blocks),
+              ("lexers", benchmark_lexers),
+              ("strings", benchmark_strings),
+              ("small_files", benchmark_small_files)]
+
+def main():
+    names = sys.argv[1:] or [name for name, fn in BENCHMARKS]
+    for name, fn in BENCHMARKS:
+        if name in names:
+            print("%s: %s" % (name, fn.__doc__))
+            fn()
+
+if __name__ == "__main__":
+    main()
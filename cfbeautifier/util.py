@@ -1,11 +1,52 @@
 from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
 
 def previous_end_of_line_pos(string, lexpos):
     "Return -1 if at the beginning of string"
     return string.rfind('\n', 0, lexpos)
 
+def line_offsets(string):
+    "Return the offset of the start of each line"
+    offsets = [0]
+    index = string.find("\n")
+    while index != -1:
+        offsets.append(index + 1)
+        index = string.find("\n", index + 1)
+    return offsets
+
+def replace_file(path, write_fn):
+    """
+    Write a temporary file with write_fn, called with the file open for writing text, and rename it
+    to path, so that path is replaced only once it is written and is never read half written. The
+    file has the permissions of the file it replaces, or of a new file. Raises IOError or OSError if
+    fails to write, or what write_fn raises, after which the file in path is as it was.
+    """
+    handle, temp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)),
+                                         prefix = "." + os.path.basename(path) + ".",
+                                         suffix = ".tmp")
+    try:
+        with os.fdopen(handle, "w") as file:
+            write_fn(file)
+        if os.path.exists(path):
+            shutil.copymode(path, temp_path)
+        else: # Permissions of a new file, rather than the private ones of a temporary file
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_path, 0o666 & ~umask)
+        try:
+            os.rename(temp_path, path)
+        except OSError: # Windows does not replace existing files
+            os.remove(path)
+            os.rename(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
 class ParserError(Exception):
     def __init__(self, fragment, line_number, input_string, lexpos):
         def column(input, lexpos):
@@ -1,3 +1,4 @@
+import codecs
 import sys
 
 if sys.version_info[0] < 3:
@@ -10,6 +11,10 @@ if sys.version_info[0] < 3:
     def string_from_stream(stream):
         return stream.read().decode('utf-8-sig')
 
+    def text_stream(stream):
+        "Return stream that reads text from (byte) stream"
+        return codecs.getreader('utf-8-sig')(stream)
+
     def write_stream(stream, output):
         stream.write(output.encode("utf-8"))
 
@@ -23,5 +28,8 @@ else:
     def string_from_stream(stream):
         return stream.read()
 
+    def text_stream(stream):
+        return stream
+
     def write_stream(stream, output):
         stream.write(output)